@@ -0,0 +1,276 @@
+"""
+  Benchmarks of svndiff.
+
+  Measures parsing of synthetic diffs (diffparser.get_files), rendering
+  of the email template (template.render) and an end-to-end check of a
+  module stored in a local file:// repository created with svnadmin.
+  Every benchmark runs in a forked process so that its peak memory
+  (maximum resident set size) is measured alone.
+
+  Usage::
+
+    python bench/bench.py [--runs N] [--scale N] [--only NAME] [--output FILE]
+
+  Results are printed (or written to FILE) as JSON so that results of
+  different versions can be compared.
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import subprocess
+import cPickle as pickle
+from optparse import OptionParser
+from ConfigParser import ConfigParser
+from cgi import escape as escape_html
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BENCH_DIR, "..", "svndiff")
+TEMPLATE_FILE = os.path.join(BENCH_DIR, "..", "templates", "simple.html")
+
+sys.path.insert(0, SOURCE_DIR)
+
+# name -> (files, lines per file, line length, property changes)
+DIFF_SHAPES = {
+    "many-files": (2000, 10, 40, False),
+    "huge-file": (1, 100000, 40, False),
+    "long-lines": (50, 100, 2000, False),
+    "properties": (500, 10, 40, True),
+}
+
+def make_diff(files, lines, line_length, properties=False):
+    """
+    Returns synthetic svn diff of files with lines changed lines each,
+    a third of lines is added, a third removed and a third unchanged
+
+    >>> make_diff(1, 3, 5).splitlines()[4:]
+    ['@@ -1,2 +1,2 @@', ' 0xxxx', '-1xxxx', '+2xxxx']
+    """
+    out = []
+    for f in range(files):
+        path = "dir%d/file%d.txt" % (f % 10, f)
+        out.append("Index: %s\n" % path)
+        out.append("=" * 67 + "\n")
+        out.append("--- %s\t(revision 1)\n" % path)
+        out.append("+++ %s\t(revision 2)\n" % path)
+        out.append("@@ -1,%d +1,%d @@\n" % (lines - lines // 3, lines - lines // 3))
+        for i in range(lines):
+            text = str(i).ljust(line_length, "x")
+            out.append(" -+"[i % 3] + text + "\n")
+        if properties:
+            out.append("\n")
+            out.append("Property changes on: %s\n" % path)
+            out.append("_" * 67 + "\n")
+            out.append("Added: svn:keywords\n")
+            out.append("   + Id Revision\n")
+            out.append("\n")
+    return "".join(out)
+
+def bench_parse(options, shape):
+    import diffparser
+    diff = make_diff(*scaled(DIFF_SHAPES[shape], options.scale))
+    files = []
+    def run():
+        del files[:]
+        files.extend(diffparser.get_files(diff, "http://svn/repo"))
+    seconds = timed(run, options.runs)
+    return {"seconds": seconds, "bytes": len(diff), "files": len(files)}
+
+def bench_render(options, shape):
+    import diffparser
+    import template
+    diff = make_diff(*scaled(DIFF_SHAPES[shape], options.scale))
+    files = diffparser.get_files(diff, "http://svn/repo")
+    context = {
+        "revision": 2,
+        "author": "author",
+        "timestamp": "2010-05-05 11:34:56 +0000",
+        "message": "message",
+        "diff": escape_html(diff),
+        "files": files,
+        "omitted": [],
+        "truncated": False,
+        "files_count": len(files),
+        "lines_added": sum([f.lines_added for f in files]),
+        "lines_removed": sum([f.lines_removed for f in files])
+    }
+    t = template.load(TEMPLATE_FILE)
+    output = []
+    def run():
+        output[:] = [t.render(context)]
+    seconds = timed(run, options.runs)
+    return {"seconds": seconds, "bytes": len(diff), "output_bytes": len(output[0])}
+
+def bench_check(options, commits, backend="cli"):
+    """
+    Creates repository with commits revisions (every one changing
+    a few files) and checks the module once using svn backend,
+    diffs are written to files
+    """
+    work_dir = tempfile.mkdtemp(prefix="svndiff-bench-")
+    try:
+        repo_dir = os.path.join(work_dir, "repo")
+        wc_dir = os.path.join(work_dir, "wc")
+        url = "file://%s" % repo_dir
+        svn("svnadmin", "create", repo_dir)
+        svn("svn", "mkdir", "-q", "-m", "trunk", url + "/trunk")
+        svn("svn", "checkout", "-q", url + "/trunk", wc_dir)
+        for c in range(commits * options.scale):
+            for f in range(5):
+                path = os.path.join(wc_dir, "file%d.txt" % f)
+                new = not os.path.exists(path)
+                out = open(path, "a")
+                out.write(("line %d of revision %d\n" % (f, c)) * 20)
+                out.close()
+                if new:
+                    svn("svn", "add", "-q", path)
+            svn("svn", "commit", "-q", "-m", "commit %d" % c, wc_dir)
+
+        # state and spool of svndiff are kept in the work directory
+        os.environ["HOME"] = work_dir
+        import svndiff
+        cfg = ConfigParser(svndiff.DEFAULT_CONFIG)
+        cfg.add_section(svndiff.MAIN_CONFIG_SECTION)
+        cfg.set(svndiff.MAIN_CONFIG_SECTION, svndiff.OPT_FROM_DOMAIN, "localhost")
+        cfg.set(svndiff.MAIN_CONFIG_SECTION, svndiff.OPT_DIFF_CACHE_SIZE, "0")
+        cfg.set(svndiff.MAIN_CONFIG_SECTION, svndiff.OPT_SVN_BACKEND, backend)
+        cfg.add_section("BENCH")
+        cfg.set("BENCH", svndiff.OPT_REPO, url + "/trunk")
+        cfg.set("BENCH", svndiff.OPT_DIFF_DIR, os.path.join(work_dir, "diffs"))
+
+        # the first revision is checked, the rest is pending
+        store = svndiff.get_state_store()
+        state = store.get("BENCH")
+        state.last_checked = 1
+        store.save(state)
+
+        started = time.time()
+        svndiff.check_module(cfg, "BENCH", url + "/trunk")
+        queue = svndiff.get_delivery_queue(cfg)
+        queue.join()
+        seconds = time.time() - started
+        queue.cancel()
+        return {"seconds": seconds, "revisions": store.get("BENCH").revisions}
+    finally:
+        shutil.rmtree(work_dir, True)
+
+def scaled(shape, scale):
+    (files, lines, line_length, properties) = shape
+    return (files * scale, lines, line_length, properties)
+
+def timed(function, runs):
+    """Returns the best time of runs calls of function in seconds"""
+    best = None
+    for i in range(runs):
+        started = time.time()
+        function()
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def svn(*command):
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (output, error) = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError("%s failed: %s" % (" ".join(command), error.strip()))
+    return output
+
+def has_svn():
+    try:
+        svn("svnadmin", "--version", "--quiet")
+        return True
+    except (OSError, RuntimeError):
+        return False
+
+def has_bindings():
+    import bindings
+    return bindings.AVAILABLE
+
+def run_forked(function, args):
+    """
+    Runs function in a child process and returns its result with
+    peak memory of the child in KiB
+    """
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = function(*args)
+        except Exception, e:
+            result = {"error": str(e)}
+        out = os.fdopen(write_fd, "wb")
+        pickle.dump(result, out)
+        out.close()
+        os._exit(0)
+
+    os.close(write_fd)
+    f = os.fdopen(read_fd, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    (pid, status, usage) = os.wait4(pid, 0)
+    if not data:
+        return {"error": "benchmark process failed with status %d" % status}
+    result = pickle.loads(data)
+    # ru_maxrss is in KiB on Linux
+    result["peak_memory_kb"] = usage.ru_maxrss
+    return result
+
+def get_benchmarks():
+    """Returns list of (name, function, args)"""
+    benchmarks = []
+    for shape in sorted(DIFF_SHAPES.keys()):
+        benchmarks.append(("parse/%s" % shape, bench_parse, (shape,)))
+    for shape in sorted(DIFF_SHAPES.keys()):
+        benchmarks.append(("render/%s" % shape, bench_render, (shape,)))
+    benchmarks.append(("check/20-revisions", bench_check, (20,)))
+    benchmarks.append(("check/20-revisions-bindings", bench_check, (20, "bindings")))
+    return benchmarks
+
+def main():
+    parser = OptionParser(usage="%prog [--runs N] [--scale N] [--only NAME] [--output FILE]")
+    parser.add_option("-n", "--runs", type="int", default=5, help="runs of every benchmark, the best is reported")
+    parser.add_option("-s", "--scale", type="int", default=1, help="multiply size of generated diffs and repository")
+    parser.add_option("--only", help="run only benchmarks which name starts with NAME")
+    parser.add_option("-o", "--output", help="write JSON results to FILE instead of stdout")
+    (options, args) = parser.parse_args()
+
+    results = []
+    for (name, function, args) in get_benchmarks():
+        if options.only and not name.startswith(options.only):
+            continue
+        if function is bench_check and not has_svn():
+            result = {"skipped": "svnadmin not found"}
+        elif "bindings" in args and not has_bindings():
+            result = {"skipped": "Subversion Python bindings not found"}
+        else:
+            result = run_forked(function, (options,) + args)
+        result["name"] = name
+        print >> sys.stderr, "%-24s %s" % (name, result.get("seconds", result.get("error", result.get("skipped"))))
+        results.append(result)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "runs": options.runs,
+        "scale": options.scale,
+        "results": results
+    }
+    out = sys.stdout
+    if options.output:
+        out = open(options.output, "w")
+    try:
+        json.dump(report, out, indent=2, sort_keys=True)
+        out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+  This module stores diffs in an archive instead of one file per
+  revision.
+
+  Diffs are compressed one by one and appended to segment files which
+  are rolled over when they reach their maximum size. An sqlite index
+  keeps module, revision, date and author of every diff together with
+  its position in a segment so that a single diff is read without
+  decompressing anything else. Appends are serialized by a lock file
+  so that the archive can be written by more processes (e.g. the daemon
+  and an import).
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path
+import re
+import zlib
+import fcntl
+import sqlite3
+import logging
+from threading import Lock
+
+LOG = logging.getLogger("archive")
+
+INDEX_FILE = "index.db"
+LOCK_FILE = "lock"
+SEGMENT_SUFFIX = ".seg"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS diffs (
+    module TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    author TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (module, revision)
+);
+CREATE INDEX IF NOT EXISTS diffs_date ON diffs (date);
+CREATE INDEX IF NOT EXISTS diffs_author ON diffs (author);
+"""
+
+COLUMNS = "module, revision, date, author, segment, offset, length"
+
+# diff files written by send_diff_to_file
+DIFF_FILE_RE = re.compile(r"^(.+)-(\d+)\.diff$")
+# number of imported diffs written with one fsync and index transaction
+IMPORT_BATCH_SIZE = 100
+
+class Entry:
+    """Position of a diff in the archive"""
+    def __init__(self, module, revision, date, author, segment, offset, length):
+        self.module = module
+        self.revision = revision
+        self.date = date
+        self.author = author
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+    def __repr__(self):
+        return "%s r%d %s %s" % (self.module, self.revision, self.date, self.author)
+
+class Archive:
+    """
+    Archive of diffs in directory:
+
+    archive = Archive("/path/to/archive", segment_size=64 * 1024 * 1024)
+    archive.append("module", 10, "2010-05-05", "author", text)
+    archive.get("module", 10)
+    archive.find(module="module", author="author", since="2010-05-01")
+
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> archive = Archive(directory, segment_size=10)
+    >>> archive.append("P1", 10, "2010-05-05", "bob", "diff 10")
+    >>> archive.append("P1", 11, "2010-05-06", "al", "diff 11")
+    >>> archive.get("P1", 11)
+    'diff 11'
+    >>> archive.find(module="P1", author="bob")
+    [P1 r10 2010-05-05 bob]
+    >>> sorted([name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)])
+    ['00001.seg', '00002.seg']
+    >>> archive.close()
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._lock = Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(os.path.join(directory, INDEX_FILE), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self._lock_file = open(os.path.join(directory, LOCK_FILE), "a")
+        segments = sorted([name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)])
+        self._segment = segments and segments[-1] or None
+
+    def append(self, module, revision, date, author, text):
+        """
+        Append diff to the current segment and index it. Diff which is
+        already archived is replaced.
+        """
+        self.extend([(module, revision, date, author, text)])
+
+    def extend(self, diffs):
+        """
+        Append list of diffs given as (module, revision, date, author,
+        text) like append, every written segment is synced once and all
+        diffs are indexed in one transaction
+        """
+        compressed = [(module, revision, date, author, zlib.compress(text))
+                      for (module, revision, date, author, text) in diffs]
+        rows = []
+        with self._lock:
+            # offsets are valid only if no other process appends meanwhile
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                f = None
+                try:
+                    for (module, revision, date, author, data) in compressed:
+                        if f is not None and offset >= self.segment_size:
+                            _close_segment(f)
+                            f = None
+                        if f is None:
+                            segment = self._current_segment()
+                            f = open(os.path.join(self.directory, segment), "ab")
+                            f.seek(0, os.SEEK_END)
+                            offset = f.tell()
+                        f.write(data)
+                        rows.append((module, revision, date, author, segment, offset, len(data)))
+                        offset += len(data)
+                finally:
+                    if f is not None:
+                        _close_segment(f)
+                with self._conn:
+                    self._conn.executemany("INSERT OR REPLACE INTO diffs (%s) VALUES (?, ?, ?, ?, ?, ?, ?)" % COLUMNS,
+                                           rows)
+            finally:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def get(self, module, revision):
+        """Returns archived diff or None"""
+        entries = self.find(module, revision, revision)
+        if not entries:
+            return None
+        return self.read(entries[0])
+
+    def find(self, module=None, first=None, last=None, author=None, since=None, until=None):
+        """
+        Returns list of Entry of archived diffs matching all given
+        conditions ordered by module and revision. Dates are YYYY-MM-DD.
+        """
+        conditions = []
+        params = []
+        for (condition, value) in (("module = ?", module), ("revision >= ?", first), ("revision <= ?", last),
+                                   ("author = ?", author), ("date >= ?", since), ("date <= ?", until)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        sql = "SELECT %s FROM diffs" % COLUMNS
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY module, revision"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [Entry(*row) for row in rows]
+
+    def read(self, entry):
+        """Returns diff of Entry"""
+        f = open(os.path.join(self.directory, entry.segment), "rb")
+        try:
+            f.seek(entry.offset)
+            return zlib.decompress(f.read(entry.length))
+        finally:
+            f.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            self._lock_file.close()
+
+    def _current_segment(self):
+        if self._segment is not None:
+            path = os.path.join(self.directory, self._segment)
+            if not os.path.exists(path) or os.path.getsize(path) < self.segment_size:
+                return self._segment
+            number = int(self._segment[:-len(SEGMENT_SUFFIX)]) + 1
+        else:
+            number = 1
+        self._segment = "%05d%s" % (number, SEGMENT_SUFFIX)
+        LOG.info("Starting archive segment %s" % self._segment)
+        return self._segment
+
+def _close_segment(f):
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+def import_diff_dir(archive, diff_dir, module=None, logins=None):
+    """
+    Import diff files (<module>-<revision>.diff) written by older
+    versions from diff_dir and its subdirectories. Only diffs of the
+    given module are imported if module is given. Returns number of
+    imported diffs, diffs which are already archived are skipped.
+    Diffs are archived with author logins like diffs sent to the
+    archive, logins maps (readable) names written in the files to logins.
+    """
+    if logins is None:
+        logins = {}
+    files = []
+    for (directory, dirs, names) in os.walk(diff_dir):
+        for name in names:
+            m = DIFF_FILE_RE.match(name)
+            if m is None or (module is not None and m.group(1) != module):
+                continue
+            files.append((m.group(1), int(m.group(2)), os.path.join(directory, name)))
+    files.sort()
+
+    archived = set([(entry.module, entry.revision) for entry in archive.find(module)])
+    imported = 0
+    batch = []
+    for (file_module, revision, path) in files:
+        if (file_module, revision) in archived:
+            continue
+        f = open(path, "r")
+        try:
+            text = f.read()
+        finally:
+            f.close()
+        (author, date) = parse_diff_header(text)
+        batch.append((file_module, revision, date, logins.get(author, author), text))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            archive.extend(batch)
+            imported += len(batch)
+            batch = []
+    if batch:
+        archive.extend(batch)
+        imported += len(batch)
+    return imported
+
+def parse_diff_header(text):
+    """
+    Returns (author, date) from header of diff file
+
+    >>> parse_diff_header('''Index: commit message
+    ... @@ -0,0 +0,0 @@
+    ...
+    ... Author    : John Black
+    ... Timestamp : 2010-05-05 12:34:56 +0100 (Wed, 05 May 2010)
+    ... ''')
+    ('John Black', '2010-05-05')
+    """
+    author = ""
+    date = ""
+    for line in text[:4096].splitlines():
+        if line.startswith("Author    : "):
+            author = line[12:].strip()
+        elif line.startswith("Timestamp : "):
+            date = line[12:22]
+        elif line.startswith("Index: ") and author:
+            break
+    return (author, date)
@@ -0,0 +1,286 @@
+"""
+  This module reads repositories through the Subversion Python
+  bindings instead of running svn for every operation.
+
+  Every check thread opens one RA session per repository root and
+  keeps it open across polls, the latest revision and logs are read
+  through it. Diffs are made by svn_client_diff_peg4 with the client
+  context of the thread, so configuration and credentials are not
+  loaded again for every revision. Sessions, contexts and their pools
+  are never shared by threads, so calls of different threads run
+  concurrently. Diffs limited to a few paths are left to the svn
+  command line client.
+
+  svn_timeout and max_diff_read_size are checked whenever the bindings
+  check for cancellation, which they do regularly while working.
+
+  The bindings are imported as libsvn.* because svn is the name of
+  the module running the svn command.
+"""
+
+from __future__ import with_statement
+
+import os
+import time
+import logging
+import tempfile
+from threading import local
+
+from svn import SubversionHelper, SubversionException, Log, ChangedPath, format_xml_date
+
+try:
+    import libsvn.core as svn_core
+    import libsvn.client as svn_client
+    import libsvn.ra as svn_ra
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+LOG = logging.getLogger("bindings")
+
+# pool, client context, RA sessions (repository root -> _Session) and
+# _Limit of the running call of every thread
+_local = local()
+
+class BindingsHelper(SubversionHelper):
+    """
+    SubversionHelper using the Subversion Python bindings. timeout
+    stops calls when the bindings check for cancellation, a call waiting
+    for the network is stopped by timeouts of the Subversion
+    configuration (e.g. http-timeout in ~/.subversion/servers).
+    """
+
+    def get_info(self):
+        started = time.time()
+        with self._session("info") as session:
+            info = {
+                "URL": self.repo,
+                "Repository Root": session.root,
+                "Repository UUID": svn_ra.svn_ra_get_uuid2(session.ra),
+                "Revision": str(svn_ra.svn_ra_get_latest_revnum(session.ra))
+            }
+        self._observe("info", started, 0)
+        return info
+
+    def get_revision(self):
+        started = time.time()
+        with self._session("info") as session:
+            revision = svn_ra.svn_ra_get_latest_revnum(session.ra)
+        self._observe("info", started, 0)
+        return revision
+
+    def get_logs(self, rev_from, rev_to):
+        """
+        Returns list of Log objects (with changed paths) for all
+        revisions from rev_from to rev_to that changed the repository URL
+        """
+        logs = []
+        def receiver(entry, pool):
+            paths = []
+            for (path, change) in sorted((entry.changed_paths2 or {}).items()):
+                kind = None
+                if change.node_kind == svn_core.svn_node_dir:
+                    kind = "dir"
+                elif change.node_kind == svn_core.svn_node_file:
+                    kind = "file"
+                copyfrom_rev = None
+                if change.copyfrom_path is not None:
+                    copyfrom_rev = change.copyfrom_rev
+                paths.append(ChangedPath(change.action, path, kind, change.copyfrom_path, copyfrom_rev))
+            revprops = entry.revprops or {}
+            logs.append(Log(revprops.get("svn:author", ""),
+                            format_xml_date(revprops.get("svn:date", "")),
+                            revprops.get("svn:log", "").strip(),
+                            entry.revision,
+                            paths))
+
+        started = time.time()
+        with self._session("log") as session:
+            relative = self.repo[len(session.root):].strip("/")
+            svn_ra.svn_ra_get_log2(session.ra, [relative], rev_from, rev_to, 0, True, False, False,
+                                   ["svn:author", "svn:date", "svn:log"], receiver, session.pool)
+        self._observe("log", started, 0)
+        return logs
+
+    def _open_diff(self, revision, paths = None, max_size = 0):
+        if paths:
+            return SubversionHelper._open_diff(self, revision, paths, max_size)
+
+        out = tempfile.TemporaryFile()
+        err = tempfile.TemporaryFile()
+        # output after max_size bytes is not read, the diff is stopped
+        # as soon as it is written
+        limit = _Limit(self.timeout, out, max_size)
+        _local.limit = limit
+        try:
+            pool = svn_core.svn_pool_create(_get_pool())
+            try:
+                svn_client.svn_client_diff_peg4([], self.repo, _revision(svn_core.svn_opt_revision_head),
+                                                _revision(svn_core.svn_opt_revision_number, revision - 1),
+                                                _revision(svn_core.svn_opt_revision_number, revision),
+                                                None, svn_core.svn_depth_infinity, False, False, False,
+                                                "UTF-8", out, err, None, _get_context(), pool)
+            finally:
+                svn_core.svn_pool_destroy(pool)
+        except (svn_core.SubversionException, _Cancelled), e:
+            if not limit.truncated:
+                out.close()
+                raise SubversionException("diff -r %d:%d %s" % (revision - 1, revision, self.repo), limit.error(e))
+        finally:
+            _local.limit = None
+            err.close()
+        out.seek(0)
+        return _DiffOutput(out)
+
+    def _session(self, command):
+        return _SessionCall(self.repo, command, self.timeout)
+
+class _Session:
+    def __init__(self, ra, root):
+        self.ra = ra
+        self.root = root
+        self.pool = None
+
+class _SessionCall:
+    """
+    Context manager returning the RA session of the current thread to
+    the repository of url, the session is opened by the first call and
+    closed if a call fails
+    """
+    def __init__(self, url, command, timeout = 0):
+        self.url = url
+        self.command = command
+        self.limit = _Limit(timeout)
+        self.session = None
+
+    def __enter__(self):
+        _local.limit = self.limit
+        try:
+            self.session = _find_session(self.url)
+            if self.session is None:
+                self.session = _open_session(self.url)
+        except (svn_core.SubversionException, _Cancelled), e:
+            _local.limit = None
+            raise SubversionException("%s %s" % (self.command, self.url), self.limit.error(e))
+        self.session.pool = svn_core.svn_pool_create(_get_pool())
+        return self.session
+
+    def __exit__(self, type, value, traceback):
+        _local.limit = None
+        svn_core.svn_pool_destroy(self.session.pool)
+        self.session.pool = None
+        if type is not None:
+            # the connection might be broken, open a new one next time
+            _get_sessions().pop(self.session.root, None)
+        if isinstance(value, (svn_core.SubversionException, _Cancelled)):
+            raise SubversionException("%s %s" % (self.command, self.url), self.limit.error(value))
+        return False
+
+class _Cancelled(Exception):
+    pass
+
+class _Limit:
+    """
+    Deadline of a call (if timeout is positive) and maximum size of its
+    output written to file out (if max_size is positive), checked by the
+    cancel function of the client context of the thread
+    """
+    def __init__(self, timeout, out = None, max_size = 0):
+        self.deadline = None
+        if timeout > 0:
+            self.deadline = time.time() + timeout
+        self.out = out
+        self.max_size = max_size
+        self.timed_out = False
+        self.truncated = False
+
+    def check(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            self.timed_out = True
+            raise _Cancelled("timed out")
+        if self.max_size > 0 and os.fstat(self.out.fileno()).st_size > self.max_size:
+            self.truncated = True
+            raise _Cancelled("output is longer than %d bytes" % self.max_size)
+
+    def error(self, e):
+        """Returns message of exception e raised by a call"""
+        if self.timed_out:
+            # the same message as svn.svn_error
+            return "timed out"
+        return str(e)
+
+def _cancel():
+    """Cancel function of client contexts, stops calls exceeding their _Limit"""
+    limit = getattr(_local, "limit", None)
+    if limit is not None:
+        limit.check()
+
+def _find_session(url):
+    for (root, session) in _get_sessions().items():
+        if url == root or url.startswith(root.rstrip("/") + "/"):
+            return session
+    return None
+
+def _open_session(url):
+    LOG.info("Opening RA session of %s" % url)
+    ra = svn_client.svn_client_open_ra_session(url, _get_context(), _get_pool())
+    root = svn_ra.svn_ra_get_repos_root2(ra)
+    # log paths are relative to the session URL
+    svn_ra.svn_ra_reparent(ra, root)
+    session = _Session(ra, root)
+    _get_sessions()[root] = session
+    return session
+
+def _get_sessions():
+    sessions = getattr(_local, "sessions", None)
+    if sessions is None:
+        sessions = {}
+        _local.sessions = sessions
+    return sessions
+
+def _get_pool():
+    """Returns pool of the current thread, the global pool is never used"""
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = svn_core.svn_pool_create()
+        _local.pool = pool
+    return pool
+
+def _get_context():
+    context = getattr(_local, "context", None)
+    if context is None:
+        pool = _get_pool()
+        svn_core.svn_config_ensure(None, pool)
+        context = svn_client.svn_client_create_context(pool)
+        context.config = svn_core.svn_config_get_config(None, pool)
+        context.cancel_func = _cancel
+        # cached credentials only, never prompt
+        context.auth_baton = svn_core.svn_auth_open([
+            svn_client.svn_client_get_simple_provider(pool),
+            svn_client.svn_client_get_username_provider(pool),
+            svn_client.svn_client_get_ssl_server_trust_file_provider(pool),
+            svn_client.svn_client_get_ssl_client_cert_file_provider(pool),
+            svn_client.svn_client_get_ssl_client_cert_pw_file_provider(pool)], pool)
+        _local.context = context
+    return context
+
+def _revision(kind, number = None):
+    revision = svn_core.svn_opt_revision_t()
+    revision.kind = kind
+    if number is not None:
+        revision.value.number = number
+    return revision
+
+class _DiffOutput:
+    """Lines of diff in a temporary file, used like process.Process"""
+    def __init__(self, f):
+        self.f = f
+
+    def __iter__(self):
+        return iter(self.f)
+
+    def wait(self, check=True):
+        return 0
+
+    def close(self):
+        self.f.close()
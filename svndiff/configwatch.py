@@ -0,0 +1,84 @@
+"""
+  This module detects changes of the config file so that the running
+  daemon applies them without a restart.
+"""
+
+import os
+import logging
+
+LOG = logging.getLogger("config")
+
+class ConfigWatcher:
+    """
+    Reloads config file when its modification time or size changes:
+
+    watcher = ConfigWatcher(path, load)
+    cfg = watcher.check() # new config or None if the file is unchanged
+
+    load(path) returns parsed config, exceptions raised by load (e.g.
+    syntax errors) are logged and the file is loaded again after its
+    next change.
+
+    >>> import tempfile
+    >>> (fd, path) = tempfile.mkstemp()
+    >>> watcher = ConfigWatcher(path, lambda path: open(path).read())
+    >>> watcher.check() is None
+    True
+    >>> f = open(path, "w")
+    >>> print >> f, "[SVN-DIFF]"
+    >>> f.close()
+    >>> watcher.check()
+    '[SVN-DIFF]\\n'
+    >>> watcher.check() is None
+    True
+    >>> os.close(fd)
+    >>> os.remove(path)
+    """
+
+    def __init__(self, path, load):
+        self.path = path
+        self.load = load
+        self._stat = self._get_stat()
+
+    def check(self):
+        stat = self._get_stat()
+        if stat == self._stat:
+            return None
+        self._stat = stat
+        try:
+            cfg = self.load(self.path)
+        except Exception:
+            LOG.exception("Failed to reload %s, keeping current configuration" % self.path)
+            return None
+        LOG.info("Reloaded %s" % self.path)
+        return cfg
+
+    def _get_stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # the file is being replaced
+            return None
+        return (st.st_mtime, st.st_size)
+
+def diff_sections(old, new):
+    """
+    Returns (added, removed, changed) lists of names of sections
+    of two ConfigParsers
+
+    >>> from ConfigParser import ConfigParser
+    >>> from StringIO import StringIO
+    >>> old = ConfigParser()
+    >>> old.readfp(StringIO("[A]\\nrepo = a\\n[B]\\nrepo = b\\n[C]\\nrepo = c\\n"))
+    >>> new = ConfigParser()
+    >>> new.readfp(StringIO("[A]\\nrepo = a\\n[B]\\nrepo = b2\\n[D]\\nrepo = d\\n"))
+    >>> diff_sections(old, new)
+    (['D'], ['C'], ['B'])
+    """
+    old_sections = set(old.sections())
+    new_sections = set(new.sections())
+    added = sorted(new_sections - old_sections)
+    removed = sorted(old_sections - new_sections)
+    changed = sorted([section for section in old_sections & new_sections
+                      if sorted(old.items(section, raw=True)) != sorted(new.items(section, raw=True))])
+    return (added, removed, changed)
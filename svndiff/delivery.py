@@ -0,0 +1,276 @@
+"""
+  This module decouples fetching of diffs from sending them.
+
+  Notifications are saved to a spool directory and put to bounded
+  in-memory queues served by a small pool of sender threads.
+  Failed notifications are retried with exponential backoff, spooled
+  notifications survive restarts and are sent when the queue is
+  started again. Notifications which could not be sent after all
+  retries are moved to the failed subdirectory of the spool.
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path
+import time
+import heapq
+import urllib
+import logging
+import itertools
+import cPickle as pickle
+from Queue import Queue
+from threading import Thread, Event, Condition
+
+LOG = logging.getLogger("delivery")
+
+SPOOL_SUFFIX = ".pickle"
+FAILED_DIR = "failed"
+
+class Notification:
+    def __init__(self, module, revision, log, diff, omitted = None, truncated = False):
+        self.module = module
+        self.revision = revision
+        self.log = log
+        self.diff = diff
+        # files left out of diff (diffparser.File) and if svn diff was cut
+        self.omitted = omitted or []
+        self.truncated = truncated
+
+    def __repr__(self):
+        return "%s r%d" % (self.module, self.revision)
+
+class Digest:
+    """Notifications of several revisions of one module sent together"""
+    def __init__(self, module, notifications):
+        self.module = module
+        self.notifications = notifications
+        # the digest is delivered when its last revision is delivered
+        self.revision = notifications[-1].revision
+
+    def __repr__(self):
+        return "%s r%d-%d" % (self.module, self.notifications[0].revision, self.revision)
+
+class DeliveryQueue:
+    """
+    Sends notifications using send function in background threads:
+
+    q = DeliveryQueue(send, spool_dir, workers=2, size=100)
+    q.start()
+    q.put(Notification(module, revision, log, diff))
+    q.join() # wait until all queued notifications are processed
+    q.cancel()
+
+    Notifications of one module are always sent by the same thread
+    in the order they were put. After every successful delivery
+    delivered(notification) is called if given. Sending of a notification
+    is attempted retries + 1 times, delays between attempts start at
+    backoff seconds and double up to max_backoff. Failed notifications
+    wait for their retry in a delayed queue, not in the sender thread,
+    so that other modules of the thread are sent meanwhile; later
+    notifications of the same module wait for the retry. Notifications
+    which could not be sent are moved to the failed subdirectory of
+    spool_dir.
+
+    >>> import tempfile, shutil
+    >>> spool_dir = tempfile.mkdtemp()
+    >>> sent = []
+    >>> def send(n):
+    ...     if n.module == "P1" and n.revision == 1:
+    ...         raise IOError("P1 is down")
+    ...     sent.append(n)
+    >>> q = DeliveryQueue(send, spool_dir, workers=1, retries=1, backoff=0.2)
+    >>> q.start()
+    >>> for n in [Notification("P1", 1, None, ""), Notification("P1", 2, None, ""), Notification("P2", 1, None, "")]:
+    ...     q.put(n)
+    >>> q.join()
+    >>> sent
+    [P2 r1]
+    >>> time.sleep(0.5)
+    >>> q.join()
+    >>> sent
+    [P2 r1, P1 r2]
+    >>> os.listdir(os.path.join(spool_dir, FAILED_DIR))
+    ['P1-1.pickle']
+    >>> q.cancel()
+    >>> shutil.rmtree(spool_dir)
+    """
+
+    def __init__(self, send, spool_dir, workers=2, size=100, retries=8,
+                 backoff=30.0, max_backoff=3600.0, delivered=None):
+        self.send = send
+        self.spool_dir = spool_dir
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.delivered = delivered
+        self._queues = [Queue(size) for i in range(workers)]
+        self._threads = []
+        self._finished = Event()
+        # heap of (due time, sequence number, notification, attempt)
+        self._retries = []
+        self._retries_condition = Condition()
+        self._sequence = itertools.count()
+        self._retry_thread = None
+
+    def start(self):
+        """Start sender threads and queue notifications left in the spool"""
+        if not os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir)
+
+        for (i, q) in enumerate(self._queues):
+            t = Thread(target=self._work, args=(q,), name="sender-%d" % i)
+            t.start()
+            self._threads.append(t)
+        self._retry_thread = Thread(target=self._retry, name="sender-retry")
+        self._retry_thread.start()
+
+        spooled = []
+        for name in os.listdir(self.spool_dir):
+            if name.endswith(SPOOL_SUFFIX):
+                try:
+                    spooled.append(self._load(os.path.join(self.spool_dir, name)))
+                except Exception:
+                    LOG.exception("Failed to load spooled notification %s" % name)
+        spooled.sort(key=lambda n: (n.module, n.revision))
+        if spooled:
+            LOG.info("Queuing %d spooled notifications" % len(spooled))
+        for notification in spooled:
+            self._queue(notification).put((notification, 0))
+
+    def put(self, notification):
+        """
+        Save notification to the spool and queue it for sending.
+        Blocks if the queue is full.
+        """
+        path = self._spool_file(notification)
+        if os.path.exists(path):
+            LOG.debug("%s is already queued" % notification)
+            return
+        self._save(notification, path)
+        self._queue(notification).put((notification, 0))
+
+    def join(self):
+        """
+        Wait until all queued notifications are processed, notifications
+        waiting for a retry are not waited for
+        """
+        for q in self._queues:
+            q.join()
+
+    def cancel(self):
+        """Stop sender threads, notifications waiting for a retry stay in the spool"""
+        self._finished.set()
+        with self._retries_condition:
+            self._retries_condition.notifyAll()
+        if self._retry_thread is not None:
+            self._retry_thread.join()
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+
+    def _queue(self, notification):
+        return self._queues[hash(notification.module) % len(self._queues)]
+
+    def _spool_file(self, notification):
+        name = "%s-%d%s" % (urllib.quote(notification.module, ""), notification.revision, SPOOL_SUFFIX)
+        return os.path.join(self.spool_dir, name)
+
+    def _save(self, notification, path):
+        # write to temporary file and rename to never leave partial files
+        tmp_path = path + ".tmp"
+        f = open(tmp_path, "wb")
+        try:
+            pickle.dump(notification, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+    def _load(self, path):
+        f = open(path, "rb")
+        try:
+            return pickle.load(f)
+        finally:
+            f.close()
+
+    def _deliver(self, notification, attempt):
+        """
+        Returns False if notification is retried later, True if it was
+        sent or given up
+        """
+        try:
+            self.send(notification)
+        except Exception:
+            LOG.exception("Failed to send %s (attempt %d)" % (notification, attempt + 1))
+            if self._finished.isSet():
+                return False
+            if attempt < self.retries:
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                LOG.info("Retrying %s in %d seconds" % (notification, delay))
+                with self._retries_condition:
+                    heapq.heappush(self._retries, (time.time() + delay, self._sequence.next(), notification, attempt + 1))
+                    self._retries_condition.notifyAll()
+                return False
+            self._fail(notification)
+            return True
+        try:
+            os.remove(self._spool_file(notification))
+            if self.delivered is not None:
+                self.delivered(notification)
+        except Exception:
+            LOG.exception("Failed to complete delivery of %s" % notification)
+        return True
+
+    def _fail(self, notification):
+        failed_dir = os.path.join(self.spool_dir, FAILED_DIR)
+        LOG.error("Giving up sending %s, moving it to %s" % (notification, failed_dir))
+        try:
+            if not os.path.exists(failed_dir):
+                os.makedirs(failed_dir)
+            path = self._spool_file(notification)
+            os.rename(path, os.path.join(failed_dir, os.path.basename(path)))
+        except OSError:
+            LOG.exception("Failed to move %s to %s" % (notification, failed_dir))
+
+    def _retry(self):
+        """Puts notifications back to their queue when their retry is due"""
+        while True:
+            with self._retries_condition:
+                while not self._finished.isSet():
+                    if not self._retries:
+                        self._retries_condition.wait()
+                    elif self._retries[0][0] > time.time():
+                        self._retries_condition.wait(self._retries[0][0] - time.time())
+                    else:
+                        break
+                if self._finished.isSet():
+                    return
+                (due, sequence, notification, attempt) = heapq.heappop(self._retries)
+            self._queue(notification).put((notification, attempt))
+
+    def _work(self, q):
+        # module -> notifications waiting for a retry of an earlier notification of the module
+        waiting = {}
+        while True:
+            item = q.get()
+            try:
+                if item is None:
+                    break
+                (notification, attempt) = item
+                module = notification.module
+                if attempt == 0 and module in waiting:
+                    waiting[module].append(notification)
+                    continue
+                pending = [(notification, attempt)] + [(n, 0) for n in waiting.pop(module, [])]
+                while pending:
+                    (notification, attempt) = pending.pop(0)
+                    if not self._deliver(notification, attempt):
+                        waiting[module] = [n for (n, a) in pending]
+                        break
+            except Exception:
+                LOG.exception("Failed to complete delivery of %s" % (item,))
+            finally:
+                q.task_done()
@@ -0,0 +1,173 @@
+"""
+  This module provides on-disk cache of svn diff output.
+
+  SVN revisions never change so diffs are cached forever (until the
+  cache is bigger than its size budget) keyed by repository UUID,
+  revision and path inside the repository. Diffs are compressed with
+  zlib, the least recently used diffs are removed first. When the
+  cache exceeds its budget it is pruned to LOW_WATER of the budget so
+  that the following diffs are stored without walking the cache again.
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path
+import zlib
+import logging
+from threading import Lock
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+import metrics
+
+LOG = logging.getLogger("diffcache")
+
+CACHE_REQUESTS = metrics.counter("svndiff_diff_cache_requests_total", "Diff cache lookups", ("result",))
+
+SUFFIX = ".z"
+
+# part of the size budget left after the cache is pruned by put
+LOW_WATER = 0.8
+
+class DiffCache:
+    """
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> cache = DiffCache(directory, 1000000)
+    >>> cache.get("uuid", 10, "/trunk") is None
+    True
+    >>> cache.put("uuid", 10, "/trunk", "Index: a.txt\\n")
+    >>> cache.get("uuid", 10, "/trunk")
+    'Index: a.txt\\n'
+    >>> cache.hits, cache.misses, cache.files
+    (1, 1, 1)
+    >>> shutil.rmtree(directory)
+
+    >>> cache = DiffCache(directory, 100)
+    >>> for revision in range(20):
+    ...     cache.put("uuid", revision, "/trunk", "Index: %d.txt\\n" % revision)
+    >>> cache.size <= 100, cache.files < 20
+    (True, True)
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self.size = 0
+        self.files = 0
+        for (path, size, mtime) in self._entries():
+            self.size += size
+            self.files += 1
+
+    def get(self, uuid, revision, path):
+        """Returns cached diff or None"""
+        file_name = self._file(uuid, revision, path)
+        try:
+            f = open(file_name, "rb")
+            try:
+                diff = zlib.decompress(f.read())
+            finally:
+                f.close()
+            # modification time is used as last access time
+            os.utime(file_name, None)
+        except (IOError, OSError, zlib.error):
+            with self._lock:
+                self.misses += 1
+            CACHE_REQUESTS.inc(result="miss")
+            return None
+        with self._lock:
+            self.hits += 1
+        CACHE_REQUESTS.inc(result="hit")
+        return diff
+
+    def put(self, uuid, revision, path, diff):
+        """Store diff and remove old diffs if the cache is too big"""
+        data = zlib.compress(diff)
+        if self.max_size > 0 and len(data) > self.max_size:
+            return
+        file_name = self._file(uuid, revision, path)
+        if os.path.exists(file_name):
+            return
+        directory = os.path.dirname(file_name)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another thread
+                pass
+
+        tmp_name = "%s.%d.tmp" % (file_name, id(data))
+        f = open(tmp_name, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp_name, file_name)
+
+        with self._lock:
+            self.size += len(data)
+            self.files += 1
+            too_big = self.max_size > 0 and self.size > self.max_size
+        if too_big:
+            self._prune(int(self.max_size * LOW_WATER), self.max_size)
+
+    def prune(self, max_size=None):
+        """
+        Remove the least recently used diffs until the cache is not
+        bigger than max_size (cache size budget by default).
+        Returns number of removed diffs.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        return self._prune(max_size)
+
+    def _prune(self, max_size, limit=None):
+        """Prunes cache to max_size if it is bigger than limit"""
+        with self._lock:
+            # another thread has pruned the cache meanwhile
+            if limit is not None and self.size <= limit:
+                return 0
+            entries = list(self._entries())
+            entries.sort(key=lambda e: e[2])
+            self.size = sum([e[1] for e in entries])
+            self.files = len(entries)
+            removed = 0
+            for (path, size, mtime) in entries:
+                if self.size <= max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.size -= size
+                self.files -= 1
+                removed += 1
+        if removed:
+            LOG.info("Removed %d diffs from cache, %d bytes left" % (removed, self.size))
+        return removed
+
+    def _file(self, uuid, revision, path):
+        key = sha1(path).hexdigest()
+        return os.path.join(self.directory, uuid, "%d-%s%s" % (revision, key, SUFFIX))
+
+    def _entries(self):
+        """Yields (file, size, modification time) of all cached diffs"""
+        if not os.path.isdir(self.directory):
+            return
+        for (directory, dirs, files) in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(SUFFIX):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield (path, st.st_size, st.st_mtime)
@@ -2,10 +2,16 @@
   This module provide functions to parse output of svn diff.
 """
 
+from __future__ import with_statement
+
 import re
+import time
 import logging
+import fnmatch
 from cgi import escape as escape_html
 
+import metrics
+
 TYPE_UNMODIFIED="unmod"
 TYPE_ADDED="add"
 TYPE_REMOVED="rem"
@@ -13,13 +19,42 @@ TYPE_MODIFIED="mod"
 TYPE_COPIED="cp"
 TYPE_MOVED="mv"
 TYPE_INFO="info"
+TYPE_PROPERTY="prop"
 
 LOG = logging.getLogger("diffparser")
 
-class Change:
+PARSE_SECONDS = metrics.histogram("svndiff_parse_seconds", "Duration of parsing of diffs")
+
+class Change(object):
+    """
+    Changed line of a file. Only the raw line is stored,
+    HTML-escaped line is created when it is rendered.
+    Removed and added lines paired by word_diff have words,
+    a list of (changed, text) parts of the line.
+    """
+    __slots__ = ("text", "type", "words")
+
     def __init__(self, line, type = TYPE_UNMODIFIED):
-        self.line = escape_html(line)
+        self.text = line
         self.type = type
+        self.words = None
+
+    @property
+    def line(self):
+        return escape_html(self.text)
+
+    @property
+    def html(self):
+        """HTML-escaped line with changed words in <span class="word">"""
+        if self.words is None:
+            return self.line
+        out = []
+        for (changed, text) in self.words:
+            if changed:
+                out.append('<span class="word">%s</span>' % escape_html(text))
+            else:
+                out.append(escape_html(text))
+        return "".join(out)
         
     def __repr__(self):
         return "%s: %s" % (self.type, self.line)
@@ -28,14 +63,36 @@ class Change:
         return self.__repr__()
     
 
-class File:
-    def __init__(self, type, path, url, changes = []):
+class File(object):
+    """
+    Changed file with its changes and diffstat counters
+    (lines_added, lines_removed, lines_context, lines_info, hunks).
+    Files omitted from diff by limit_files have no changes,
+    excluded is True if the file matched an exclude pattern.
+    binary is True if svn doesn't show content of the file,
+    properties is list of names of changed properties.
+    """
+    __slots__ = ("type", "path", "url", "changes", "rev_from", "rev_to",
+                 "lines_added", "lines_removed", "lines_context", "lines_info", "hunks",
+                 "excluded", "binary", "properties")
+
+    def __init__(self, type, path, url, changes = None):
+        if changes is None:
+            changes = []
         self.type = type
         self.path = path
         self.url = url
         self.changes = changes
         self.rev_from = 0
         self.rev_to = 0
+        self.lines_added = 0
+        self.lines_removed = 0
+        self.lines_context = 0
+        self.lines_info = 0
+        self.hunks = 0
+        self.excluded = False
+        self.binary = False
+        self.properties = []
         
     def __repr__(self):
         return "File %s (%s)" % (self.path, self.type)
@@ -43,13 +100,30 @@ class File:
     def __str__(self):
         return self.__repr__()
 
+EVENT_FILE = "file"
+EVENT_CHANGE = "change"
+EVENT_END_FILE = "endfile"
+
 INDEX = "Index: "
 REVISION_RE = re.compile ("revision (\d+)")
+PROPERTY_CHANGES = "Property changes on: "
+PROPERTY_RE = re.compile("^(Added|Modified|Deleted|Name): (.+)$")
+BINARY = "Cannot display: "
+MIME_TYPE = "svn:mime-type = "
+
+# at most one warning about unexpected lines per interval in seconds
+UNEXPECTED_WARNING_INTERVAL = 60.0
+
+# words, spaces and other characters, bytes of UTF-8 characters stay together
+WORD_RE = re.compile(r"[\w\x80-\xff]+|\s+|[^\w\s\x80-\xff]")
+# changed words are not marked in hunks with more characters of
+# removed and added lines
+WORD_DIFF_MAX_SIZE = 20000
 
 def get_files(diff, base_url):
     """
-    Parses output of svn diff and return list of 
-    modified/added/deleted files.
+    Parses output of svn diff (string or iterable of lines) and
+    return list of modified/added/deleted files.
     
     >>> get_files('''Index: srm-pom/pom.xml
     ... ===================================================================
@@ -93,76 +167,514 @@ def get_files(diff, base_url):
     ... +        <version>1.116-SNAPSHOT</version>
     ...      </parent>''', 'http://svn/')
     [File srm-pom/pom.xml (mod), File test.txt (add), File test2.txt (rem), File psfo-messagekit/pom.xml (mod)]
+    >>> [(f.lines_added, f.lines_removed, f.hunks) for f in _]
+    [(1, 1, 1), (3, 0, 1), (0, 3, 1), (1, 1, 1)]
+
+    Binary files and property changes:
+
+    >>> files = get_files('''Index: logo.png
+    ... ===================================================================
+    ... Cannot display: file marked as a binary type.
+    ... svn:mime-type = application/octet-stream
+    ...
+    ... Property changes on: logo.png
+    ... ___________________________________________________________________
+    ... Added: svn:mime-type
+    ... ## -0,0 +1 ##
+    ... +application/octet-stream
+    ...
+    ... Property changes on: trunk
+    ... ___________________________________________________________________
+    ... Modified: svn:mergeinfo
+    ...    Merged /branches/b1:r5-10''', 'http://svn/')
+    >>> [(f.path, f.type, f.binary, f.properties) for f in files]
+    [('logo.png', 'mod', True, ['svn:mime-type']), ('trunk', 'mod', False, ['svn:mergeinfo'])]
+    >>> files[1].changes
+    [prop: Modified: svn:mergeinfo, prop:    Merged /branches/b1:r5-10]
+
+    Changed words of removed and added lines:
+
+    >>> files = get_files('''Index: a.properties
+    ... ===================================================================
+    ... --- a.properties (revision 1)
+    ... +++ a.properties (revision 2)
+    ... @@ -1,2 +1,2 @@
+    ...  name = a
+    ... -timeout = 10 # seconds
+    ... +timeout = 30 # seconds''', 'http://svn/')
+    >>> [c.html for c in files[0].changes[2:]]
+    ['timeout = <span class="word">10</span> # seconds', 'timeout = <span class="word">30</span> # seconds']
+    """
+    if isinstance(diff, basestring):
+        diff = iter_lines(diff)
+    with PARSE_SECONDS.time():
+        return [f for (event, f) in parse(diff, base_url) if event == EVENT_END_FILE]
+
+def parse(lines, base_url):
+    """
+    Parses output of svn diff given as iterable of lines (e.g. read
+    from svn process) and yields parse events as soon as they
+    are found:
+
+    - (EVENT_FILE, file) when new file section starts
+    - (EVENT_CHANGE, change) for every change of the current file
+    - (EVENT_END_FILE, file) when file section is completed and
+      type of the file is known
+
+    Changes are also appended to the changes list of the current file.
+
+    >>> for event in parse(iter_lines('''Index: test.txt
+    ... ===================================================================
+    ... --- text.txt (revision 0)
+    ... +++ test.txt (revision 3417)
+    ... @@ -0,0 +1,1 @@
+    ... +1'''), 'http://svn/'):
+    ...     print event
+    ('file', File test.txt (mod))
+    ('change', info: @@ -0,0 +1,1 @@)
+    ('change', add: 1)
+    ('endfile', File test.txt (add))
     """
     
     if base_url.endswith("/"):
         base_url = base_url[:-1]
     
-    files = []
-    for line in diff.splitlines():
+    file = None
+    # property changes section of the current file
+    properties = False
+    for line in lines:
+        line = line.rstrip("\r\n")
         if line.startswith(INDEX):
+            if file is not None:
+                _finish(file)
+                yield (EVENT_END_FILE, file)
+
             file_path = line[len(INDEX):] 
             
-            files.append(File(TYPE_MODIFIED,                   # type 
-                              file_path,                       # path
-                              "%s/%s" % (base_url, file_path), # url
-                              []                               # changes
-                        ))
+            file = File(TYPE_MODIFIED,                   # type 
+                        file_path,                       # path
+                        "%s/%s" % (base_url, file_path), # url
+                        []                               # changes
+                   )
+            properties = False
+            yield (EVENT_FILE, file)
+        elif line.startswith(PROPERTY_CHANGES):
+            # properties of the current file or of a path without
+            # content changes (e.g. directory)
+            path = line[len(PROPERTY_CHANGES):]
+            if file is None or file.path != path:
+                if file is not None:
+                    _finish(file)
+                    yield (EVENT_END_FILE, file)
+                file = File(TYPE_MODIFIED, path, "%s/%s" % (base_url, path), [])
+                yield (EVENT_FILE, file)
+            properties = True
+        elif not line:
+            # sections are separated by empty lines
+            pass
+        elif properties:
+            c = _property_change(file, line)
+            if c is not None:
+                file.changes.append(c)
+                yield (EVENT_CHANGE, c)
         elif line.startswith("========="):
             # skip seprator line
             pass
+        elif file is not None and (line.startswith(BINARY) or
+                                   (file.binary and line.startswith(MIME_TYPE))):
+            # "Cannot display: file marked as a binary type."
+            file.binary = True
+            c = Change(line, TYPE_INFO)
+            file.lines_info += 1
+            file.changes.append(c)
+            yield (EVENT_CHANGE, c)
         elif line.startswith("---"):
             # parse from revision
             m = REVISION_RE.search(line)
             if m is not None:
-                files[-1].rev_from = int(m.group(1))
+                file.rev_from = int(m.group(1))
         elif line.startswith("+++"):
             # parse to revision
             m = REVISION_RE.search(line)
             if m is not None:
-                files[-1].rev_to = int(m.group(1))
+                file.rev_to = int(m.group(1))
         elif line.startswith("@@"):
             # information about changed lines
-            files[-1].changes.append(Change(line, TYPE_INFO))
+            c = Change(line, TYPE_INFO)
+            file.hunks += 1
+            file.lines_info += 1
+            file.changes.append(c)
+            yield (EVENT_CHANGE, c)
         elif line.startswith("\\"):
             # "No newline at end of file"
-            files[-1].changes.append(Change(line, TYPE_INFO))
-        elif len(files) != 0:
+            c = Change(line, TYPE_INFO)
+            file.lines_info += 1
+            file.changes.append(c)
+            yield (EVENT_CHANGE, c)
+        elif file is not None:
             # changes
             c = Change(line[1:])
             if line.startswith("+"):
                 c.type = TYPE_ADDED
-            if line.startswith("-"):
+                file.lines_added += 1
+            elif line.startswith("-"):
                 c.type = TYPE_REMOVED
-            files[-1].changes.append(c)
+                file.lines_removed += 1
+            else:
+                file.lines_context += 1
+            file.changes.append(c)
+            yield (EVENT_CHANGE, c)
         else:
-            # TODO: handle properties changes
-            # Exmaple of svn diff:
-            #
-            #Property changes on: srm-admin-ui
-            #___________________________________________________________________
-            #Name: svn:ignore
-            #   - target
-            #
-            #   + target
-            #.classpath
-            #.project
-            #.settings
-            LOG.warn("Unexpected line: %s" % line)
-            LOG.debug("Diff\n: %s" % diff)
-
-    # do some after pricessing
-    for file in files:
-        # if from_rev is 0 then file was added
-        if file.rev_from == 0:
-            file.type = TYPE_ADDED
-
-        # if number of changes with type 'REMOVED' is equal to the 
-        # total number of changes the file was removed
-        if len(filter(lambda c: c.type != TYPE_INFO, file.changes)) == len(filter(lambda c: c.type == TYPE_REMOVED, file.changes)):
-            file.type = TYPE_REMOVED
-
-    return files
+            _warn_unexpected(line)
+
+    if file is not None:
+        _finish(file)
+        yield (EVENT_END_FILE, file)
+
+def limit_files(lines, max_size, exclude = None, base_url = ""):
+    """
+    Splits svn diff given as iterable of lines into whole file diffs
+    which fit into max_size bytes (0 means no limit) and files which are
+    omitted. Once a file doesn't fit all following files are omitted,
+    files matching exclude patterns are always omitted. Lines of omitted
+    files are only counted, they are never kept in memory.
+
+    Returns (diff, omitted) where omitted is list of File without changes.
+
+    >>> (diff, omitted) = limit_files(iter_lines('''Index: a.txt
+    ... ===================================================================
+    ... --- a.txt (revision 1)
+    ... +++ a.txt (revision 2)
+    ... @@ -1 +1 @@
+    ... -a
+    ... +b
+    ... Index: big.txt
+    ... ===================================================================
+    ... --- big.txt (revision 0)
+    ... +++ big.txt (revision 2)
+    ... @@ -0,0 +1,3 @@
+    ... +1
+    ... +2
+    ... +3
+    ... Index: yarn.lock
+    ... ===================================================================
+    ... --- yarn.lock (revision 1)
+    ... +++ yarn.lock (revision 2)
+    ... @@ -1 +1 @@
+    ... -a
+    ... +b'''), 200, ["*.lock"])
+    >>> print diff.strip()
+    Index: a.txt
+    ===================================================================
+    --- a.txt (revision 1)
+    +++ a.txt (revision 2)
+    @@ -1 +1 @@
+    -a
+    +b
+    >>> [(f.path, f.type, f.lines_added, f.lines_removed, f.excluded) for f in omitted]
+    [('big.txt', 'add', 3, 0, False), ('yarn.lock', 'mod', 1, 1, True)]
+
+    Omitted files are counted like parse counts them, lines of property
+    changes are not added or removed lines:
+
+    >>> (diff, omitted) = limit_files(iter_lines('''Index: a.txt
+    ... ===================================================================
+    ... --- a.txt (revision 1)
+    ... +++ a.txt (revision 2)
+    ... @@ -1 +1 @@
+    ... -a
+    ... +b
+    ...
+    ... Property changes on: a.txt
+    ... ___________________________________________________________________
+    ... Added: svn:keywords
+    ... ## -0,0 +1 ##
+    ... +Id
+    ...
+    ... Property changes on: sub
+    ... ___________________________________________________________________
+    ... Modified: svn:ignore
+    ...    - target
+    ...    + target
+    ... .classpath'''), 1)
+    >>> [(f.path, f.lines_added, f.lines_removed, f.lines_context, f.properties) for f in omitted]
+    [('a.txt', 1, 1, 0, ['svn:keywords']), ('sub', 0, 0, 0, ['svn:ignore'])]
+
+    Blank context lines are context, not separators:
+
+    >>> text = "\\n".join(["Index: a.txt", "=" * 67, "--- a.txt (revision 1)", "+++ a.txt (revision 2)",
+    ...                   "@@ -1,3 +1 @@", "-x", " ", "-y"])
+    >>> (diff, omitted) = limit_files(iter_lines(text), 1)
+    >>> [(f.type, f.lines_added, f.lines_removed, f.lines_context) for f in omitted + get_files(text, "")]
+    [('mod', 0, 2, 1), ('mod', 0, 2, 1)]
+    """
+    if base_url.endswith("/"):
+        base_url = base_url[:-1]
+
+    diff = []
+    omitted = []
+    size = 0
+    full = False
+    file = None
+    # property changes section of the current file
+    properties = False
+    # lines of the current file while it fits
+    block = []
+    block_size = 0
+    for line in lines:
+        if not line.endswith("\n"):
+            line += "\n"
+        path = None
+        if line.startswith(INDEX):
+            path = line[len(INDEX):].rstrip("\r\n")
+        elif line.startswith(PROPERTY_CHANGES):
+            # properties of a path without content changes start a new
+            # file like in parse
+            path = line[len(PROPERTY_CHANGES):].rstrip("\r\n")
+            if file is not None and file.path == path:
+                path = None
+            properties = True
+        if path is not None:
+            if block is not None:
+                diff.extend(block)
+                size += block_size
+            elif file is not None:
+                _finish(file)
+                omitted.append(file)
+
+            file = File(TYPE_MODIFIED, path, "%s/%s" % (base_url, path))
+            properties = line.startswith(PROPERTY_CHANGES)
+            block = []
+            block_size = 0
+            if is_excluded(path, exclude):
+                file.excluded = True
+                block = None
+            elif full:
+                block = None
+
+        if file is not None:
+            if not properties:
+                _count(file, line)
+            elif line.rstrip("\r\n") and not line.startswith(PROPERTY_CHANGES):
+                _property_change(file, line.rstrip("\r\n"))
+        if block is not None:
+            if max_size > 0 and size + block_size + len(line) > max_size:
+                # budget is exhausted, the rest is only counted
+                full = True
+                block = None
+            else:
+                block.append(line)
+                block_size += len(line)
+
+    if block is not None:
+        diff.extend(block)
+    elif file is not None:
+        _finish(file)
+        omitted.append(file)
+    return ("".join(diff), omitted)
+
+def is_excluded(path, patterns):
+    """
+    Returns True if path matches one of glob patterns
+
+    >>> is_excluded("src/generated/Parser.java", ["*.lock", "*/generated/*"])
+    True
+    >>> is_excluded("src/Parser.java", ["*.lock", "*/generated/*"])
+    False
+    """
+    if not patterns:
+        return False
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(path, pattern):
+            return True
+    return False
+
+def _count(file, line):
+    """
+    Updates diffstat counters of file with the given line of its diff,
+    lines of property changes are handled by _property_change
+    """
+    if line.startswith("---"):
+        m = REVISION_RE.search(line)
+        if m is not None:
+            file.rev_from = int(m.group(1))
+    elif line.startswith("+++"):
+        m = REVISION_RE.search(line)
+        if m is not None:
+            file.rev_to = int(m.group(1))
+    elif line.startswith(INDEX) or line.startswith("=========") or not line.rstrip("\r\n"):
+        # sections are separated by empty lines, " " is a blank context line
+        pass
+    elif line.startswith(BINARY) or (file.binary and line.startswith(MIME_TYPE)):
+        file.binary = True
+        file.lines_info += 1
+    elif line.startswith("@@"):
+        file.hunks += 1
+        file.lines_info += 1
+    elif line.startswith("\\"):
+        file.lines_info += 1
+    elif line.startswith("+"):
+        file.lines_added += 1
+    elif line.startswith("-"):
+        file.lines_removed += 1
+    else:
+        file.lines_context += 1
+
+def _property_change(file, line):
+    """
+    Returns Change of a line of property changes section or None if
+    the line should be skipped. Both formats of svn are supported::
+
+      Modified: svn:ignore         Modified: svn:ignore
+         - target                  ## -1 +1,2 ##
+                                    target
+         + target                  +.classpath
+      .classpath
+    """
+    if line.startswith("____"):
+        return None
+    m = PROPERTY_RE.match(line)
+    if m is not None:
+        file.properties.append(m.group(2))
+        return Change(line, TYPE_PROPERTY)
+    if line.startswith("##"):
+        return Change(line, TYPE_INFO)
+    if line.startswith("   + ") or line.startswith("   - "):
+        # old format, values are indented
+        line = line[3:]
+        value = line[2:]
+    else:
+        value = line[1:]
+    if line.startswith("+"):
+        return Change(value, TYPE_ADDED)
+    if line.startswith("-"):
+        return Change(value, TYPE_REMOVED)
+    # merged revisions of svn:mergeinfo, values spanning more lines
+    return Change(line, TYPE_PROPERTY)
+
+# time of the last warning about unexpected line, number of suppressed warnings
+_unexpected = [0.0, 0]
+
+def _warn_unexpected(line):
+    """Log unexpected line, at most once per UNEXPECTED_WARNING_INTERVAL"""
+    now = time.time()
+    if now - _unexpected[0] < UNEXPECTED_WARNING_INTERVAL:
+        _unexpected[1] += 1
+        return
+    suppressed = ""
+    if _unexpected[1]:
+        suppressed = " (%d similar warnings suppressed)" % _unexpected[1]
+    _unexpected[0] = now
+    _unexpected[1] = 0
+    LOG.warn("Unexpected line: %s%s" % (line[:200], suppressed))
+
+def _finish(file):
+    """
+    Detects type of completely parsed file
+    """
+    # if from_rev is 0 then file was added, binary files and
+    # property changes may have no revisions
+    if file.rev_from == 0 and file.rev_to > 0:
+        file.type = TYPE_ADDED
+
+    # if number of removed lines is equal to the total
+    # number of changed and context lines the file was removed
+    # (binary files and property changes have no hunks)
+    if file.hunks > 0 and file.lines_added == 0 and file.lines_context == 0:
+        file.type = TYPE_REMOVED
+
+    if file.lines_added > 0 and file.lines_removed > 0:
+        _mark_words(file.changes)
+
+def _mark_words(changes):
+    """
+    Pairs runs of removed lines and following added lines of every hunk
+    and marks their changed words, hunks bigger than WORD_DIFF_MAX_SIZE
+    are skipped
+    """
+    hunk = []
+    size = 0
+    for c in changes + [None]:
+        if c is None or (c.type == TYPE_INFO and c.text.startswith("@@")):
+            if size <= WORD_DIFF_MAX_SIZE:
+                _mark_hunk(hunk)
+            hunk = []
+            size = 0
+        elif c.type == TYPE_ADDED or c.type == TYPE_REMOVED:
+            size += len(c.text)
+        hunk.append(c)
+
+def _mark_hunk(changes):
+    removed = []
+    added = []
+    for c in changes + [None]:
+        if c is not None and c.type == TYPE_REMOVED and not added:
+            removed.append(c)
+        elif c is not None and c.type == TYPE_ADDED and removed:
+            added.append(c)
+        else:
+            # lines are paired in order, the rest of the longer run has no pair
+            for (old, new) in zip(removed, added):
+                words = word_diff(old.text, new.text)
+                if words is not None:
+                    (old.words, new.words) = words
+            removed = []
+            added = []
+            if c is not None and c.type == TYPE_REMOVED:
+                removed.append(c)
+
+def word_diff(old, new):
+    """
+    Returns (old words, new words) of changed lines as lists of
+    (changed, text) or None if the lines have nothing in common.
+
+    Only common words at the beginning and end of the lines are
+    found, so the time is linear in the length of the lines and
+    everything between the first and last changed word is marked.
+
+    >>> word_diff("<version>1.115</version>", "<version>1.116-SNAPSHOT</version>")
+    ([(False, '<version>1.'), (True, '115'), (False, '</version>')], [(False, '<version>1.'), (True, '116-SNAPSHOT'), (False, '</version>')])
+    >>> word_diff("a = 1", "b = 2") is None
+    True
+    """
+    a = WORD_RE.findall(old)
+    b = WORD_RE.findall(new)
+    n = min(len(a), len(b))
+    prefix = 0
+    while prefix < n and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    if prefix == 0 and suffix == 0:
+        return None
+    if prefix + suffix == len(a) and prefix + suffix == len(b):
+        # equal lines
+        return None
+    return (_split_words(a, prefix, suffix), _split_words(b, prefix, suffix))
+
+def _split_words(tokens, prefix, suffix):
+    parts = [(False, "".join(tokens[:prefix])),
+             (True, "".join(tokens[prefix:len(tokens) - suffix])),
+             (False, "".join(tokens[len(tokens) - suffix:]))]
+    return [(changed, text) for (changed, text) in parts if text]
+
+def iter_lines(text):
+    """
+    Iterates over lines of the given string without splitting it
+    into a list of lines first.
+
+    >>> list(iter_lines("a\\nb\\r\\n\\nc"))
+    ['a', 'b', '', 'c']
+    """
+    start = 0
+    length = len(text)
+    while start < length:
+        end = text.find("\n", start)
+        if end < 0:
+            end = length
+        yield text[start:end].rstrip("\r")
+        start = end + 1
 
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,241 @@
+"""
+  This module collects runtime metrics (counters, gauges and
+  histograms with labels) and exposes them in Prometheus text format
+  on a local HTTP endpoint.
+
+  Metrics are defined where they are measured:
+
+    SVN_SECONDS = metrics.histogram("svndiff_svn_seconds", "Duration of svn commands", ("command",))
+    with SVN_SECONDS.time(command="diff"):
+        ...
+"""
+
+from __future__ import with_statement
+
+import time
+import logging
+from threading import Lock, Thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+LOG = logging.getLogger("metrics")
+
+# seconds
+TIME_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+# bytes
+SIZE_BUCKETS = (1000, 10000, 100000, 1000000, 10000000)
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {} # label values -> value
+        self._lock = Lock()
+
+    def _key(self, labels):
+        if sorted(labels.keys()) != sorted(self.labels):
+            raise ValueError("%s requires labels %s" % (self.name, ", ".join(self.labels)))
+        return tuple([str(labels[name]) for name in self.labels])
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join(['%s="%s"' % (name, _escape(value)) for (name, value) in pairs])
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for (key, value) in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return ["%s%s %s" % (self.name, self._format_labels(key), _number(value))]
+
+class Counter(Metric):
+    """
+    >>> c = Counter("svndiff_test_total", "Test counter", ("module",))
+    >>> c.inc(module="P1")
+    >>> c.inc(2, module="P1")
+    >>> print "\\n".join(c.render())
+    # HELP svndiff_test_total Test counter
+    # TYPE svndiff_test_total counter
+    svndiff_test_total{module="P1"} 3
+    """
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    Gauge set to a value or to a function called when the gauge is rendered
+
+    >>> g = Gauge("svndiff_test_age_seconds", "Test gauge", ("module",))
+    >>> g.set(1, module="P1")
+    >>> g.set_function(lambda: 2.5, module="P2")
+    >>> print "\\n".join(g.render())
+    # HELP svndiff_test_age_seconds Test gauge
+    # TYPE svndiff_test_age_seconds gauge
+    svndiff_test_age_seconds{module="P1"} 1
+    svndiff_test_age_seconds{module="P2"} 2.5
+    """
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function, **labels):
+        self.set(function, **labels)
+
+    def _render_value(self, key, value):
+        if callable(value):
+            value = value()
+        return Metric._render_value(self, key, value)
+
+class Histogram(Metric):
+    """
+    >>> h = Histogram("svndiff_test_seconds", "Test histogram", buckets=(1, 10))
+    >>> h.observe(0.5)
+    >>> h.observe(5)
+    >>> print "\\n".join(h.render())
+    # HELP svndiff_test_seconds Test histogram
+    # TYPE svndiff_test_seconds histogram
+    svndiff_test_seconds_bucket{le="1"} 1
+    svndiff_test_seconds_bucket{le="10"} 2
+    svndiff_test_seconds_bucket{le="+Inf"} 2
+    svndiff_test_seconds_sum 5.5
+    svndiff_test_seconds_count 2
+    """
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # count per bucket, sum, count
+                counts = [[0] * len(self.buckets), 0, 0]
+                self._values[key] = counts
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, **labels):
+        """Returns context manager observing duration of its block"""
+        return _Timer(self, labels)
+
+    def render(self):
+        with self._lock:
+            values = sorted([(key, ([list(v[0])] + v[1:])) for (key, v) in self._values.items()])
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for (key, (buckets, total, count)) in values:
+            for (bound, bucket_count) in zip(self.buckets, buckets):
+                lines.append("%s_bucket%s %d" % (self.name, self._format_labels(key, [("le", _number(bound))]), bucket_count))
+            lines.append("%s_bucket%s %d" % (self.name, self._format_labels(key, [("le", "+Inf")]), count))
+            lines.append("%s_sum%s %s" % (self.name, self._format_labels(key), _number(total)))
+            lines.append("%s_count%s %d" % (self.name, self._format_labels(key), count))
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(time.time() - self.started, **self.labels)
+        return False
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns all metrics in Prometheus text format"""
+        with self._lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+def gauge(name, help, labels=()):
+    return REGISTRY.register(Gauge(name, help, labels))
+
+def histogram(name, help, labels=(), buckets=TIME_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+def render():
+    return REGISTRY.render()
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug(format % args)
+
+class MetricsServer:
+    """
+    Serves metrics on http://host:port/metrics in a background thread
+    """
+    def __init__(self, port, host="127.0.0.1"):
+        self.port = port
+        self.host = host
+        self._server = None
+
+    def start(self):
+        self._server = HTTPServer((self.host, self.port), _Handler)
+        t = Thread(target=self._server.serve_forever, name="metrics")
+        t.setDaemon(True)
+        t.start()
+        LOG.info("Serving metrics on http://%s:%d/metrics" % (self.host, self.port))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _number(value):
+    """
+    >>> _number(3), _number(2.5), _number(1.0)
+    ('3', '2.5', '1')
+    """
+    if isinstance(value, float) and value == int(value):
+        return str(int(value))
+    return repr(value)
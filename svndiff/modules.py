@@ -0,0 +1,111 @@
+"""
+  This module describes configured modules (config sections) and
+  groups modules stored in the same SVN repository so that the
+  repository is polled only once for all of them.
+"""
+
+import urllib
+
+class Module:
+    """
+    Module (config section) with its SVN URL. If repository root is
+    known path is the path of the module inside the repository.
+
+    >>> m = Module("PROJECT1", "http://svn/repo/PROJECT%201/", "http://svn/repo", "uuid")
+    >>> m.path
+    '/PROJECT 1'
+    """
+    def __init__(self, name, repo, root = None, uuid = None):
+        self.name = name
+        self.repo = repo.rstrip("/")
+        self.root = root
+        self.uuid = uuid
+        self.path = None
+        if root is not None:
+            self.path = urllib.unquote(self.repo[len(root.rstrip("/")):]) or "/"
+
+    def touched_by(self, log):
+        """
+        Returns True if the given Log changed anything in the module.
+        If path of the module is not known it is assumed that log
+        was read for the module URL and True is returned.
+        """
+        if self.path is None:
+            return True
+        for changed in log.paths:
+            if is_subpath(changed.path, self.path) or is_subpath(self.path, changed.path):
+                return True
+        return False
+
+    def changed_paths(self, log):
+        """
+        Returns list of ChangedPath of the log which are inside
+        the module or None if path of the module is not known
+        """
+        if self.path is None:
+            return None
+        return [changed for changed in log.paths if is_subpath(changed.path, self.path)]
+
+    def relative_path(self, path):
+        """
+        Returns path relative to the module
+
+        >>> Module("P1", "http://svn/repo/P1", "http://svn/repo").relative_path("/P1/src/a.txt")
+        'src/a.txt'
+        """
+        return path[len(self.path):].lstrip("/")
+
+    def __repr__(self):
+        return "Module %s (%s)" % (self.name, self.repo)
+
+def is_subpath(path, parent):
+    """
+    >>> is_subpath("/trunk/a/b.txt", "/trunk/a")
+    True
+    >>> is_subpath("/trunk/ab", "/trunk/a")
+    False
+    >>> is_subpath("/trunk", "/")
+    True
+    """
+    return path == parent or parent == "/" or path.startswith(parent.rstrip("/") + "/")
+
+def common_url(urls):
+    """
+    Returns the longest URL which is a parent of all given URLs
+
+    >>> common_url(["http://svn/repo/PROJECT1", "http://svn/repo/PROJECT2/trunk"])
+    'http://svn/repo'
+    >>> common_url(["http://svn/repo/PROJECT1/"])
+    'http://svn/repo/PROJECT1'
+    """
+    common = urls[0].rstrip("/").split("/")
+    for url in urls[1:]:
+        parts = url.rstrip("/").split("/")
+        i = 0
+        while i < len(common) and i < len(parts) and common[i] == parts[i]:
+            i += 1
+        common = common[:i]
+    return "/".join(common)
+
+def group_modules(modules):
+    """
+    Groups modules by repository (UUID and root), modules with unknown
+    repository are put in separate groups. Returns list of lists.
+
+    >>> group_modules([Module("P1", "http://svn/repo/P1", "http://svn/repo", "u1"),
+    ...                Module("P2", "http://svn/repo/P2", "http://svn/repo", "u1"),
+    ...                Module("P3", "http://svn2/repo/P3")])
+    [[Module P1 (http://svn/repo/P1), Module P2 (http://svn/repo/P2)], [Module P3 (http://svn2/repo/P3)]]
+    """
+    groups = []
+    by_repository = {}
+    for m in modules:
+        if m.uuid is None:
+            groups.append([m])
+            continue
+        key = (m.uuid, m.root)
+        if key not in by_repository:
+            by_repository[key] = []
+            groups.append(by_repository[key])
+        by_repository[key].append(m)
+    return groups
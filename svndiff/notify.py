@@ -0,0 +1,135 @@
+"""
+  This module lets post-commit hooks of local repositories notify
+  svndiff about new revisions so that modules are checked right
+  after a commit instead of waiting for the next poll.
+
+  Notifications are lines "UUID REVISION" sent to a UNIX socket.
+"""
+
+from __future__ import with_statement
+
+import os
+import time
+import socket
+import logging
+from threading import Thread
+
+LOG = logging.getLogger("notify")
+
+class NotifyListener:
+    """
+    Listens on UNIX socket and calls notified(uuid, revision) for
+    every received notification:
+
+    listener = NotifyListener("/path/to/socket", notified, mode=0660)
+    listener.start()
+    listener.close()
+
+    Only users which may write to the socket (of the group of svndiff
+    with the default mode) can send notifications.
+
+    >>> import tempfile, shutil, time
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, "notify.sock")
+    >>> received = []
+    >>> listener = NotifyListener(path, lambda uuid, revision: received.append((uuid, revision)))
+    >>> listener.start()
+    >>> send(path, "2a7a7c4e", 42)
+    >>> listener.close()
+    >>> received
+    [('2a7a7c4e', 42)]
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, path, notified, mode=0660):
+        self.path = path
+        self.notified = notified
+        self.mode = mode
+        self._socket = None
+        self._thread = None
+        self._finished = False
+
+    def start(self):
+        """Bind the socket and start listening in a background thread"""
+        if os.path.exists(self.path):
+            # left by previous run
+            os.remove(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        # hooks usually run as a different user than svndiff
+        os.chmod(self.path, self.mode)
+        self._socket.listen(16)
+        self._thread = Thread(target=self._serve, name="notify")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        LOG.info("Listening for commit notifications on %s" % self.path)
+
+    def close(self):
+        """Stop listening and remove the socket"""
+        if self._thread is None:
+            return
+        self._finished = True
+        # wake up accept() with an empty connection
+        try:
+            send(self.path, None, None)
+        except socket.error:
+            pass
+        self._thread.join()
+        self._socket.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self._thread = None
+
+    def _serve(self):
+        while True:
+            try:
+                (conn, address) = self._socket.accept()
+            except socket.error, e:
+                if self._finished:
+                    break
+                LOG.error("Failed to accept notification connection: %s" % e)
+                # e.g. too many open files, don't spin
+                time.sleep(1.0)
+                continue
+            try:
+                # the connection waking up close() is empty
+                self._receive(conn)
+            except socket.error, e:
+                LOG.error("Failed to receive notification: %s" % e)
+            finally:
+                conn.close()
+            # connections queued before the one waking up close() are
+            # received first
+            if self._finished:
+                break
+
+    def _receive(self, conn):
+        f = conn.makefile("r")
+        try:
+            for line in f:
+                try:
+                    (uuid, revision) = line.split()
+                    revision = int(revision)
+                except ValueError:
+                    LOG.warn("Ignoring invalid notification %r" % line)
+                    continue
+                LOG.debug("Revision %d committed to repository %s" % (revision, uuid))
+                try:
+                    self.notified(uuid, revision)
+                except Exception:
+                    LOG.exception("Failed to process notification of revision %d" % revision)
+        finally:
+            f.close()
+
+def send(path, uuid, revision, timeout=10.0):
+    """Send notification about revision of repository UUID to svndiff"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(path)
+        if uuid is not None:
+            s.sendall("%s %d\n" % (uuid, revision))
+    finally:
+        s.close()
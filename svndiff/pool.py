@@ -0,0 +1,86 @@
+"""
+  This module runs independent tasks in a pool of threads and returns
+  their results in the order of the tasks.
+"""
+
+from __future__ import with_statement
+
+import sys
+from threading import Thread, Condition
+
+class OrderedPool:
+    """
+    Calls function for every item in worker threads, results are
+    returned in the order of items:
+
+    pool = OrderedPool(function, workers=4)
+    for result in pool.map(items):
+        ...
+
+    At most window items (twice the number of workers by default) are
+    processed or waiting to be returned at the same time so that fast
+    workers don't keep many results in memory. An exception raised by
+    function is raised by map when its result is due. Workers stop
+    taking new items when the iteration stops.
+
+    >>> import time
+    >>> def square(x):
+    ...     time.sleep((10 - x) * 0.001)
+    ...     return x * x
+    >>> list(OrderedPool(square, workers=3).map(range(10)))
+    [0, 1, 4, 9, 16, 25, 36, 49, 64, 81]
+    """
+
+    def __init__(self, function, workers=4, window=None):
+        self.function = function
+        self.workers = max(workers, 1)
+        self.window = window or self.workers * 2
+        self._condition = Condition()
+
+    def map(self, items):
+        items = list(items)
+        # index -> (True, result) or (False, exc_info)
+        self._results = {}
+        self._next = 0
+        self._returned = 0
+        self._finished = False
+        self._items = items
+
+        for i in range(min(self.workers, len(items))):
+            t = Thread(target=self._work, name="pool-%d" % i)
+            t.setDaemon(True)
+            t.start()
+
+        try:
+            for i in range(len(items)):
+                with self._condition:
+                    while i not in self._results:
+                        self._condition.wait()
+                    (ok, result) = self._results.pop(i)
+                    self._returned = i + 1
+                    self._condition.notifyAll()
+                if not ok:
+                    raise result[0], result[1], result[2]
+                yield result
+        finally:
+            with self._condition:
+                self._finished = True
+                self._condition.notifyAll()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._finished and self._next < len(self._items) \
+                        and self._next - self._returned >= self.window:
+                    self._condition.wait()
+                if self._finished or self._next >= len(self._items):
+                    return
+                i = self._next
+                self._next += 1
+            try:
+                result = (True, self.function(self._items[i]))
+            except Exception:
+                result = (False, sys.exc_info())
+            with self._condition:
+                self._results[i] = result
+                self._condition.notifyAll()
@@ -0,0 +1,187 @@
+"""
+  This module runs external commands without a shell.
+
+  Every command runs in its own process group with an optional
+  wall-clock timeout, when the timeout expires the whole process
+  group is killed. Exit codes are checked and ProcessError with
+  the standard error output is raised on failure.
+"""
+
+from __future__ import with_statement
+
+import os
+import time
+import errno
+import signal
+import select
+import tempfile
+import threading
+import subprocess
+
+class ProcessError(Exception):
+    def __init__(self, command, returncode, stderr):
+        Exception.__init__(self, command, returncode, stderr)
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+
+    def __str__(self):
+        return "%s exited with code %s: %s" % (" ".join(self.command), self.returncode, self.stderr.strip())
+
+class ProcessTimeout(ProcessError):
+    def __str__(self):
+        return "%s timed out: %s" % (" ".join(self.command), self.stderr.strip())
+
+class Process:
+    """
+    Runs command (list of arguments) and gives access to its output:
+
+    p = Process(["svn", "info", url], timeout=60)
+    for line in p:
+        ...
+    p.wait() # raises ProcessError if command failed or timed out
+
+    If timeout is 0 or negative the command is never killed.
+    """
+
+    def __init__(self, command, timeout=0, watch=True):
+        self.command = command
+        self.timeout = timeout
+        self.timed_out = False
+        self.deadline = None
+        if timeout > 0:
+            self.deadline = time.time() + timeout
+
+        # stderr goes to a file so that it can never block the process
+        self._stderr = tempfile.TemporaryFile()
+        self._popen = subprocess.Popen(command,
+                                       stdout=subprocess.PIPE,
+                                       stderr=self._stderr,
+                                       close_fds=True,
+                                       preexec_fn=os.setsid)
+        self.pid = self._popen.pid
+        self.stdout = self._popen.stdout
+
+        self._timer = None
+        if watch and self.deadline is not None:
+            self._timer = threading.Timer(timeout, self.expire)
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+    def __iter__(self):
+        return iter(self.stdout.readline, "")
+
+    def fileno(self):
+        return self.stdout.fileno()
+
+    def read(self):
+        """Read the whole output and wait for the command to finish"""
+        out = self.stdout.read()
+        self.wait()
+        return out
+
+    def poll(self):
+        return self._popen.poll()
+
+    def expire(self):
+        """Kill the command because its timeout expired"""
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        """Kill the whole process group of the command"""
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def close(self):
+        """Kill the command if it is still running and release resources"""
+        if self._popen.poll() is None:
+            self.kill()
+        self.wait(check=False)
+
+    def wait(self, check=True):
+        """
+        Wait for the command to finish. If check is True
+        raises ProcessError if the command failed.
+        """
+        if not self.stdout.closed:
+            self.stdout.close()
+        returncode = self._popen.wait()
+        if self._timer is not None:
+            self._timer.cancel()
+
+        if check and (self.timed_out or returncode != 0):
+            self._stderr.seek(0)
+            stderr = self._stderr.read()
+            if self.timed_out:
+                raise ProcessTimeout(self.command, returncode, stderr)
+            raise ProcessError(self.command, returncode, stderr)
+        return returncode
+
+def run(command, timeout=0):
+    """Run command and return its output"""
+    return Process(command, timeout).read()
+
+def run_many(commands, timeout=0, limit=0):
+    """
+    Runs commands concurrently from the calling thread without a
+    thread per command, output of all running commands is read
+    using select(). At most limit commands run at the same time
+    (no limit if 0).
+
+    Returns list of (output, error) tuples in the same order as
+    commands, error is None or ProcessError.
+
+    >>> run_many([["echo", "1"], ["sh", "-c", "echo 2; exit 3"]])
+    [('1\\n', None), ('2\\n', ProcessError(['sh', '-c', 'echo 2; exit 3'], 3, ''))]
+    >>> run_many([["sleep", "10"]], timeout=0.1)[0][1]
+    ProcessTimeout(['sleep', '10'], -9, '')
+    """
+    results = [None] * len(commands)
+    pending = list(enumerate(commands))
+    pending.reverse()
+    running = {} # fd -> (index, process, list of output chunks)
+
+    while pending or running:
+        while pending and (limit <= 0 or len(running) < limit):
+            index, command = pending.pop()
+            p = Process(command, timeout, watch=False)
+            running[p.fileno()] = (index, p, [])
+
+        wait = None
+        deadlines = [p.deadline for (i, p, out) in running.values() if p.deadline is not None]
+        if deadlines:
+            wait = max(min(deadlines) - time.time(), 0)
+
+        try:
+            readable = select.select(running.keys(), [], [], wait)[0]
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd in readable:
+            index, p, out = running[fd]
+            chunk = os.read(fd, 65536)
+            if chunk:
+                out.append(chunk)
+                continue
+            # end of output
+            del running[fd]
+            error = None
+            try:
+                p.wait()
+            except ProcessError, e:
+                error = e
+            results[index] = ("".join(out), error)
+
+        now = time.time()
+        for (index, p, out) in running.values():
+            if p.deadline is not None and p.deadline <= now and not p.timed_out:
+                # killed process closes its output, it is collected above
+                p.expire()
+
+    return results
@@ -1,37 +1,287 @@
 """
   Very simple scheduler.
-  Calls given function
-  
-  TODO: docs, tests
+  Calls given functions regularly using a bounded pool of
+  worker threads.
 """
 
-from threading import Thread, Event
+from __future__ import with_statement
 
-class Scheduler(Thread):
-    """Call a function regularly:
+import time
+import heapq
+import random
+import logging
+from threading import Thread, Condition
 
-    s = Scheduler(30.0, f, args=[], kwargs={})
-    s.start()
-    s.cancel() # stop the scheduler
-    """
+LOG = logging.getLogger("scheduler")
 
-    def __init__(self, interval, function, args=[], kwargs={}):
-        Thread.__init__(self)
+class Job:
+    def __init__(self, name, interval, function, args, kwargs, key,
+                 min_interval=None, max_interval=None):
+        self.name = name
         self.interval = interval
+        # interval is adapted between these limits
+        self.min_interval = min_interval or interval
+        self.max_interval = max_interval or interval
         self.function = function
         self.args = args
         self.kwargs = kwargs
-        self.finished = Event()
+        self.key = key
+        self.cancelled = False
+        self.running = False
+        # key of the running call, the key can be changed meanwhile
+        self.running_key = None
+        # run again as soon as the running call finishes
+        self.triggered = False
+
+    def __repr__(self):
+        return "Job %s" % self.name
+
+class Scheduler:
+    """Call functions regularly:
+
+    s = Scheduler(workers=4, max_per_key=2, jitter=60.0)
+    s.add("name", 30.0, f, args=[], kwargs={}, key="server")
+    s.start()
+    s.trigger("name") # run the job now
+    s.update("name", 60.0, args=[], key="server") # change the next runs
+    s.remove("name")
+    s.cancel() # stop the scheduler
+
+    Jobs are kept in a queue ordered by the time they are due and are
+    run by at most `workers` threads. At most `max_per_key` jobs with
+    the same key (e.g. SVN server host) run at the same time. The first
+    run of every job is delayed by a random time up to `jitter` seconds.
+    Jobs with interval 0 or less run only once, the scheduler stops
+    when there are no more jobs to run.
+
+    Interval of a job added with min_interval or max_interval adapts
+    to the value returned by the function: true value (activity) sets
+    it to min_interval, false value (but not None) multiplies it by
+    backoff up to max_interval.
+
+    >>> s = Scheduler(backoff=2.0)
+    >>> job = s.add("name", 60, None, min_interval=30, max_interval=200)
+    >>> for result in (False, False, False, True, None):
+    ...     s._adapt(job, result)
+    ...     print "%d" % job.interval
+    120
+    200
+    200
+    30
+    30
+    """
+
+    def __init__(self, workers=4, max_per_key=0, jitter=0.0, backoff=2.0):
+        self.workers = workers
+        self.max_per_key = max_per_key
+        self.jitter = jitter
+        self.backoff = backoff
+        self.jobs = {}
+        self._queue = [] # heap of (due time, sequence number, job)
+        self._seq = 0
+        self._running = {} # key -> number of running jobs
+        self._running_count = 0
+        self._cond = Condition()
+        self._finished = False
+        self._threads = []
+
+    def add(self, name, interval, function, args=[], kwargs={}, key=None,
+            min_interval=None, max_interval=None):
+        """Schedule function to be called every interval seconds"""
+        job = Job(name, interval, function, args, kwargs, key, min_interval, max_interval)
+        with self._cond:
+            self.jobs[name] = job
+            self._push(job, time.time() + random.uniform(0, self.jitter))
+            self._cond.notifyAll()
+        return job
+
+    def trigger(self, name):
+        """
+        Run job as soon as possible instead of waiting for its interval.
+        If the job is running it is run again right after it finishes.
+        Returns False if there is no such job.
+        """
+        with self._cond:
+            job = self.jobs.get(name)
+            if job is None or job.cancelled:
+                return False
+            if job.running:
+                job.triggered = True
+                return True
+            now = time.time()
+            for (i, (due, seq, queued)) in enumerate(self._queue):
+                if queued is job and due > now:
+                    self._queue[i] = (now, seq, job)
+                    heapq.heapify(self._queue)
+                    self._cond.notifyAll()
+                    break
+            return True
+
+    def update(self, name, interval, args=None, kwargs=None, key=None,
+               min_interval=None, max_interval=None):
+        """
+        Change interval, arguments and key of job. A running call is
+        not affected, the changes apply to the next runs. The job stays
+        due at the same time unless the new interval is shorter than
+        the time left. Returns False if there is no such job.
+
+        >>> s = Scheduler()
+        >>> job = s.add("name", 600, None)
+        >>> s.update("name", 60, args=[1])
+        True
+        >>> job.interval, job.args, s._queue[0][0] - time.time() <= 60
+        (60, [1], True)
+        """
+        with self._cond:
+            job = self.jobs.get(name)
+            if job is None or job.cancelled:
+                return False
+            if args is not None:
+                job.args = args
+            if kwargs is not None:
+                job.kwargs = kwargs
+            job.key = key
+            job.interval = interval
+            job.min_interval = min_interval or interval
+            job.max_interval = max_interval or interval
+            if not job.running and interval > 0:
+                now = time.time()
+                for (i, (due, seq, queued)) in enumerate(self._queue):
+                    if queued is job and due > now + interval:
+                        self._queue[i] = (now + interval, seq, job)
+                        heapq.heapify(self._queue)
+                        break
+            self._cond.notifyAll()
+            return True
+
+    def remove(self, name):
+        """
+        Stop running the job, a running call is left to finish.
+        Returns False if there is no such job.
+        """
+        with self._cond:
+            job = self.jobs.pop(name, None)
+            if job is None:
+                return False
+            job.cancelled = True
+            self._cond.notifyAll()
+            return True
+
+    def checks_per_hour(self):
+        """Returns number of job runs per hour with current intervals"""
+        with self._cond:
+            return sum([3600.0 / job.interval for job in self.jobs.values()
+                        if job.interval > 0 and not job.cancelled])
+
+    def start(self):
+        """Start worker threads"""
+        for i in range(self.workers):
+            t = Thread(target=self._work, name="worker-%d" % i)
+            t.start()
+            self._threads.append(t)
 
     def cancel(self):
         """Stop the scheduler"""
-        self.finished.set()
+        with self._cond:
+            self._finished = True
+            self._cond.notifyAll()
+
+    def join(self, timeout=None):
+        """
+        Wait for all worker threads to finish. Returns False if
+        they are still running after timeout seconds.
+        """
+        if timeout is None:
+            for t in self._threads:
+                t.join()
+            return True
+        deadline = time.time() + timeout
+        for t in self._threads:
+            t.join(max(deadline - time.time(), 0))
+        return not [t for t in self._threads if t.isAlive()]
+
+    def _push(self, job, due):
+        self._seq += 1
+        heapq.heappush(self._queue, (due, self._seq, job))
 
-    def run(self):
+    def _pop_ready(self, now):
+        """
+        Returns the first due job which key is not at its concurrency
+        limit or None if there is no such job
+        """
+        skipped = []
+        job = None
+        while self._queue and self._queue[0][0] <= now:
+            entry = heapq.heappop(self._queue)
+            candidate = entry[2]
+            if candidate.cancelled:
+                continue
+            if self.max_per_key > 0 and self._running.get(candidate.key, 0) >= self.max_per_key:
+                skipped.append(entry)
+                continue
+            job = candidate
+            break
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        return job
+
+    def _next_job(self):
+        with self._cond:
+            while not self._finished:
+                now = time.time()
+                job = self._pop_ready(now)
+                if job is not None:
+                    self._running[job.key] = self._running.get(job.key, 0) + 1
+                    self._running_count += 1
+                    job.running = True
+                    job.running_key = job.key
+                    return job
+
+                if not self._queue and self._running_count == 0:
+                    # all jobs have been run and none will be rescheduled
+                    return None
+
+                timeout = None
+                if self._queue and self._queue[0][0] > now:
+                    timeout = self._queue[0][0] - now
+                # otherwise wait for a running job to finish
+                self._cond.wait(timeout)
+            return None
+
+    def _adapt(self, job, result):
+        """Change interval of the job according to result of its function"""
+        if job.interval <= 0 or job.min_interval >= job.max_interval or result is None:
+            return
+        old = job.interval
+        if result:
+            job.interval = job.min_interval
+        else:
+            job.interval = min(job.interval * self.backoff, job.max_interval)
+        if job.interval != old:
+            LOG.info("Running %s every %d seconds (was %d), %.1f runs per hour in total"
+                     % (job.name, job.interval, old, self.checks_per_hour()))
+
+    def _done(self, job, result):
+        with self._cond:
+            self._adapt(job, result)
+            self._running[job.running_key] -= 1
+            self._running_count -= 1
+            job.running = False
+            if job.triggered and not job.cancelled:
+                job.triggered = False
+                self._push(job, time.time())
+            elif job.interval > 0 and not job.cancelled:
+                self._push(job, time.time() + job.interval)
+            self._cond.notifyAll()
+
+    def _work(self):
         while True:
-            if self.finished.isSet():
-                break
-            self.function(*self.args, **self.kwargs)
-            if self.interval <= 0:
+            job = self._next_job()
+            if job is None:
                 break
-            self.finished.wait(self.interval)
+            result = None
+            try:
+                result = job.function(*job.args, **job.kwargs)
+            except Exception:
+                LOG.exception("Failed to run %s" % job.name)
+            self._done(job, result)
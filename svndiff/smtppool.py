@@ -0,0 +1,124 @@
+"""
+  This module provides a pool of persistent SMTP connections
+  which can be shared by all threads sending emails.
+"""
+
+from __future__ import with_statement
+
+import time
+import socket
+import smtplib
+import logging
+from threading import Lock, BoundedSemaphore
+
+LOG = logging.getLogger("smtppool")
+
+class _Connection:
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = time.time()
+
+class SMTPPool:
+    """
+    Keeps up to size connections to SMTP server open between messages.
+
+    Connection which has been idle for more than check_after seconds
+    is checked with NOOP before it is used, broken connections are
+    replaced with new ones. Connection is closed after it was used to
+    send max_messages messages (0 means no limit).
+
+    >>> class FakeSMTP:
+    ...     connections = 0
+    ...     def __init__(self, host):
+    ...         FakeSMTP.connections += 1
+    ...     def sendmail(self, from_addr, to_addrs, msg):
+    ...         pass
+    ...     def noop(self):
+    ...         return (250, "OK")
+    ...     def quit(self):
+    ...         pass
+    >>> pool = SMTPPool("localhost", max_messages=2, factory=FakeSMTP)
+    >>> for i in range(3):
+    ...     pool.sendmail("from@server.com", ["to@server.com"], "message")
+    >>> FakeSMTP.connections
+    2
+    """
+
+    def __init__(self, host, size=2, max_messages=100, check_after=30.0, factory=smtplib.SMTP):
+        self.host = host
+        self.max_messages = max_messages
+        self.check_after = check_after
+        self.factory = factory
+        self._idle = []
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(size)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Send message using one of pooled connections.
+        If connection was closed by server the message is
+        sent again using a new connection.
+        """
+        self._slots.acquire()
+        try:
+            conn = self._get()
+            try:
+                try:
+                    result = conn.smtp.sendmail(from_addr, to_addrs, msg)
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    LOG.info("Connection to %s lost, reconnecting", self.host)
+                    self._quit(conn)
+                    conn = self._connect()
+                    result = conn.smtp.sendmail(from_addr, to_addrs, msg)
+            except Exception:
+                # the connection may be in the middle of a message
+                self._quit(conn)
+                raise
+
+            conn.messages += 1
+            conn.last_used = time.time()
+            if self.max_messages > 0 and conn.messages >= self.max_messages:
+                self._quit(conn)
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+            return result
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            self._quit(conn)
+
+    def _get(self):
+        """Returns healthy idle connection or a new one"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if time.time() - conn.last_used < self.check_after or self._alive(conn):
+                return conn
+            self._quit(conn)
+        return self._connect()
+
+    def _connect(self):
+        LOG.debug("Connecting to %s", self.host)
+        return _Connection(self.factory(self.host))
+
+    def _alive(self, conn):
+        try:
+            return conn.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def _quit(self, conn):
+        try:
+            conn.smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
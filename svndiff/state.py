@@ -0,0 +1,207 @@
+"""
+  This module keeps state of checked modules (last checked and last
+  delivered revisions, poll statistics) in a single sqlite database.
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path
+import logging
+import sqlite3
+from threading import Lock
+
+LOG = logging.getLogger("state")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS modules (
+    module TEXT PRIMARY KEY,
+    last_checked INTEGER NOT NULL DEFAULT -1,
+    last_delivered INTEGER NOT NULL DEFAULT -1,
+    last_poll REAL,
+    poll_duration REAL,
+    polls INTEGER NOT NULL DEFAULT 0,
+    revisions INTEGER NOT NULL DEFAULT 0,
+    skipped INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# columns added after the first version of the schema
+UPGRADES = (
+    ("skipped", "ALTER TABLE modules ADD COLUMN skipped INTEGER NOT NULL DEFAULT 0"),
+)
+
+COLUMNS = "last_checked, last_delivered, last_poll, poll_duration, polls, revisions, skipped"
+
+class ModuleState:
+    def __init__(self, module, last_checked=-1, last_delivered=-1, last_poll=None,
+                 poll_duration=None, polls=0, revisions=0, skipped=0):
+        self.module = module
+        self.last_checked = last_checked
+        self.last_delivered = last_delivered
+        self.last_poll = last_poll
+        self.poll_duration = poll_duration
+        self.polls = polls
+        # revisions with changes in the module and skipped revisions
+        self.revisions = revisions
+        self.skipped = skipped
+
+    def __repr__(self):
+        return "%s: checked r%d, delivered r%d" % (self.module, self.last_checked, self.last_delivered)
+
+class StateStore:
+    """
+    State of all modules:
+
+    store = StateStore("state.db")
+    state = store.get("module")
+    state.last_checked = 123
+    store.save(state)
+
+    >>> store = StateStore(":memory:")
+    >>> store.get("PROJECT1")
+    PROJECT1: checked r-1, delivered r-1
+    >>> state = store.get("PROJECT1")
+    >>> state.last_checked = 10
+    >>> store.save(state)
+    >>> store.set_delivered("PROJECT1", 9)
+    >>> store.get("PROJECT1")
+    PROJECT1: checked r10, delivered r9
+    >>> store.advance_checked("PROJECT1", 20, 30), store.advance_checked("PROJECT1", 5, 15)
+    (False, True)
+    >>> state.last_checked = 12
+    >>> store.save(state)
+    >>> store.get("PROJECT1")
+    PROJECT1: checked r15, delivered r9
+    >>> store.set_checkpoint("backfill.PROJECT1", "1:100:50")
+    >>> print store.get_checkpoint("backfill.PROJECT1")
+    1:100:50
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # write ahead log makes writes cheap and never blocks readers
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(modules)")]
+        for (column, sql) in UPGRADES:
+            if column not in columns:
+                self._conn.execute(sql)
+        self._conn.commit()
+
+    def get(self, module):
+        """Returns ModuleState of the given module"""
+        with self._lock:
+            row = self._conn.execute("SELECT %s FROM modules WHERE module = ?" % COLUMNS,
+                                     (module,)).fetchone()
+        if row is None:
+            return ModuleState(module)
+        return ModuleState(module, *row)
+
+    def get_all(self):
+        """Returns list of ModuleState of all known modules"""
+        with self._lock:
+            rows = self._conn.execute("SELECT module, %s FROM modules ORDER BY module" % COLUMNS).fetchall()
+        return [ModuleState(*row) for row in rows]
+
+    def save(self, state):
+        """
+        Atomically save checked revision and poll statistics of the
+        module. Last delivered revision is updated by set_delivered only.
+        Checked revision is never moved back, e.g. by a poll which started
+        before advance_checked was called by another process.
+        """
+        with self._lock:
+            with self._conn:
+                self._ensure(state.module)
+                self._conn.execute("UPDATE modules SET last_checked = MAX(last_checked, ?), last_poll = ?, "
+                                   "poll_duration = ?, polls = ?, revisions = ?, skipped = ? WHERE module = ?",
+                                   (state.last_checked, state.last_poll, state.poll_duration,
+                                    state.polls, state.revisions, state.skipped, state.module))
+
+    def set_delivered(self, module, revision):
+        """Save last delivered revision of the module"""
+        with self._lock:
+            with self._conn:
+                self._ensure(module)
+                self._conn.execute("UPDATE modules SET last_delivered = ? WHERE module = ? AND last_delivered < ?",
+                                   (revision, module, revision))
+
+    def advance_checked(self, module, first, last):
+        """
+        Atomically set checked revision of the module to last if it is
+        unknown or if revisions first to last were checked by other means
+        (e.g. backfill) right after it. Returns False if the checked
+        revision is before first - 1 (revisions in between would never
+        be checked) or already last or later.
+        """
+        with self._lock:
+            with self._conn:
+                self._ensure(module)
+                cursor = self._conn.execute("UPDATE modules SET last_checked = ? WHERE module = ? AND "
+                                            "(last_checked < 0 OR (last_checked >= ? AND last_checked < ?))",
+                                            (last, module, first - 1, last))
+                return cursor.rowcount > 0
+
+    def get_checkpoint(self, name):
+        """Returns value of checkpoint saved by set_checkpoint or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE name = ?",
+                                     ("checkpoint." + name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_checkpoint(self, name, value):
+        """Save progress of a long running command, e.g. backfill"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                                   ("checkpoint." + name, value))
+
+    def migrate(self, last_revs_dir, delivered_revs_dir=None):
+        """
+        Import revisions from one-file-per-module directories used
+        by older versions. Done only once.
+        """
+        with self._lock:
+            with self._conn:
+                if self._conn.execute("SELECT value FROM meta WHERE name = 'migrated'").fetchone() is not None:
+                    return
+                for (column, directory) in (("last_checked", last_revs_dir), ("last_delivered", delivered_revs_dir)):
+                    if directory is None or not os.path.isdir(directory):
+                        continue
+                    for module in os.listdir(directory):
+                        revision = _read_revision(os.path.join(directory, module))
+                        if revision is None:
+                            continue
+                        LOG.info("Importing %s = %d of module %s" % (column, revision, module))
+                        self._ensure(module)
+                        self._conn.execute("UPDATE modules SET %s = ? WHERE module = ?" % column,
+                                           (revision, module))
+                self._conn.execute("INSERT INTO meta (name, value) VALUES ('migrated', '1')")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _ensure(self, module):
+        self._conn.execute("INSERT OR IGNORE INTO modules (module) VALUES (?)", (module,))
+
+def _read_revision(path):
+    try:
+        f = open(path, 'r')
+        try:
+            return int(f.read())
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        LOG.warn("Ignoring invalid revision file %s" % path)
+        return None
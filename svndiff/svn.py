@@ -1,15 +1,32 @@
 """
   This module provides wrappers for svn command to perform
   operations required by svn-diff application.
-  
-  TODO: improve error handling (check exit code of svn)
+
+  svn is run without a shell, non-interactively and with
+  a timeout, SubversionException is raised if svn fails.
 """
 
 from __future__ import with_statement
 
-import os
 import re
+import time
+import calendar
 import exceptions
+from cStringIO import StringIO
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+from process import Process, ProcessError, ProcessTimeout, run, run_many
+import metrics
+
+SVN_SECONDS = metrics.histogram("svndiff_svn_seconds", "Duration of svn commands",
+                                ("command", "repo"))
+SVN_BYTES = metrics.counter("svndiff_svn_bytes_total", "Output of svn commands in bytes",
+                            ("command", "repo"))
+SVN_ERRORS = metrics.counter("svndiff_svn_errors_total", "Failed svn commands",
+                             ("command", "repo"))
 
 class SubversionException(exceptions.Exception):
     def __init__(self, svn_command, msg):
@@ -22,64 +39,372 @@ class SubversionException(exceptions.Exception):
     def __str__(self):
         return self.__repr__()
 
+class ChangedPath:
+    def __init__(self, action, path, kind = None, copyfrom_path = None, copyfrom_rev = None):
+        self.action = action
+        self.path = path
+        self.kind = kind
+        self.copyfrom_path = copyfrom_path
+        self.copyfrom_rev = copyfrom_rev
+
+    def __repr__(self):
+        return "%s %s" % (self.action, self.path)
+
 class Log:
-    def __init__(self, author, timestamp, message):
+    def __init__(self, author, timestamp, message, revision = None, paths = None):
         self.author = author
         self.author_name = author
         self.timestamp = timestamp
         self.message = message
+        self.revision = revision
+        if paths is None:
+            paths = []
+        self.paths = paths
 
     def date(self):
         return self.timestamp.split(" ")[0]
 
 class SubversionHelper:
     REVISION_RE = re.compile("Revision: (\d+)")
-    LOG_INFO_RE = re.compile(r"r(\d+) \| (\w+) \| (.*) \|")
         
-    def __init__(self, repo):
+    def __init__(self, repo, timeout = 0, cache = None, uuid = None, path = None):
+        """
+        timeout is maximum time in seconds every svn command
+        can run (no limit if 0). If cache (DiffCache), repository
+        uuid and path of the URL in the repository are given diffs
+        are read from the cache first.
+        """
         self.repo = repo
+        self.timeout = timeout
+        self.cache = cache
+        self.uuid = uuid
+        self.path = path
+
+    def _command(self, *args):
+        return ["svn", "--non-interactive"] + list(args)
+
+    def _open(self, command):
+        try:
+            return Process(command, self.timeout)
+        except OSError, e:
+            raise SubversionException(" ".join(command), str(e))
+
+    def _run(self, command):
+        started = time.time()
+        p = self._open(command)
+        try:
+            output = p.read()
+        except ProcessError, e:
+            self._observe(command[2], started, 0, True)
+            raise svn_error(e)
+        self._observe(command[2], started, len(output))
+        return output
+
+    def _observe(self, name, started, size, failed = False):
+        """Record duration and output size of svn command"""
+        labels = {"command": name, "repo": self.repo}
+        SVN_SECONDS.observe(time.time() - started, **labels)
+        SVN_BYTES.inc(size, **labels)
+        if failed:
+            SVN_ERRORS.inc(**labels)
         
+    def get_info(self):
+        """
+        Returns output of svn info as dictionary, e.g.
+        {'Repository Root': 'http://svnserver.com/repo', 'Revision': '42', ...}
+        """
+        return parse_info(self._run(self._command("info", self.repo)))
+
     def get_revision(self):
         """
         Returns latest repository revision
         """
-        command = 'svn info "%s"' % self.repo
-        with os.popen(command) as out:
-            for line in out:
-                matches = self.REVISION_RE.findall(line)
-                if len(matches) > 0:
-                    return int(matches[0])
+        command = self._command("info", self.repo)
+        for line in self._run(command).splitlines():
+            matches = self.REVISION_RE.findall(line)
+            if len(matches) > 0:
+                return int(matches[0])
         # error occured
-        raise SubversionException(command, "Unable to find the latest revision of '%s'" % self.repo)
+        raise SubversionException(" ".join(command), "Unable to find the latest revision of '%s'" % self.repo)
         
     def get_log(self, revision):
         """
         Returns log for the given revision as Log object.
         If there is no log for the given revision returns None
         """
-        command = 'svn log -r %d "%s"' % (revision, self.repo)
-        
-        author = timestamp = None
-        message = ""
-
-        with os.popen(command) as out:
-            for line in out:
-                m = self.LOG_INFO_RE.match(line)
-                if author is not None and not line.startswith(10 * "-") and not len(line.strip()) == 0:
-                    message += line
-                if m is not None:
-                    author = m.group(2)
-                    timestamp = m.group(3)
-        
-        if author is not None:
-            return Log(author, timestamp, message.strip())
+        for log in self.get_logs(revision, revision):
+            return log
         return None
-    
-    def get_last_diff(self, revision):
+
+    def get_logs(self, rev_from, rev_to):
+        """
+        Yields Log objects (with changed paths) for all revisions
+        from rev_from to rev_to that changed the repository URL.
+
+        All logs are fetched with a single svn log command and its
+        XML output is parsed as it arrives.
+        """
+        command = self._command("log", "--xml", "-v", "-r", "%d:%d" % (rev_from, rev_to), self.repo)
+
+        started = time.time()
+        failed = True
+        p = self._open(command)
+        try:
+            for log in parse_xml_log(p.stdout):
+                yield log
+            _wait(p)
+            failed = False
+        except SyntaxError:
+            # incomplete output, report svn error if there is one
+            _wait(p)
+            raise
+        except GeneratorExit:
+            # the caller doesn't need more logs
+            failed = False
+            raise
+        finally:
+            p.close()
+            self._observe("log", started, 0, failed)
+
+    def get_last_diff(self, revision, max_size = 0, paths = None):
         """
         Return output from svn diff for given revision. 
+        If max_size is positive at most max_size bytes are returned.
         """
-        command = 'svn diff -r %d:%d "%s"' % (revision - 1, revision, self.repo)
-        
-        with os.popen(command) as out:
-            return out.read()
+        return "".join(self.get_diff_stream(revision, max_size, paths))
+
+    def get_diff_stream(self, revision, max_size = 0, paths = None):
+        """
+        Return DiffStream that yields output from svn diff
+        for given revision line by line. If paths (relative to
+        the repository URL) are given only these paths are compared.
+        """
+        if self.cache is None or self.uuid is None or self.path is None:
+            return DiffStream(self, revision, paths, max_size)
+
+        key = self.path
+        if paths:
+            key = "\0".join((self.path,) + tuple(paths))
+        cached = self.cache.get(self.uuid, revision, key)
+        if cached is not None:
+            return DiffStream(self, revision, paths, max_size, cached = cached)
+        return DiffStream(self, revision, paths, max_size,
+                          on_complete = lambda diff: self.cache.put(self.uuid, revision, key, diff))
+
+    def _open_diff(self, revision, paths = None, max_size = 0):
+        """
+        Starts svn diff of the revision, returns Process which yields
+        output lines and raises ProcessError in wait() if svn failed.
+        Output after max_size bytes is not read, svn is killed when the
+        Process is closed.
+        """
+        if paths:
+            command = self._command("diff",
+                                    "--old=%s@%d" % (self.repo, revision - 1),
+                                    "--new=%s@%d" % (self.repo, revision),
+                                    "--")
+            command.extend(paths)
+        else:
+            command = self._command("diff", "-r", "%d:%d" % (revision - 1, revision), self.repo)
+        return self._open(command)
+
+class DiffStream:
+    """
+    Iterates over lines of svn diff output as they are read from svn
+    (or over lines of cached diff).
+
+    If max_size is positive reading stops as soon as max_size bytes
+    have been read, svn process is killed and truncated is set to True.
+    If the whole output was read on_complete is called with it.
+    """
+    def __init__(self, helper, revision, paths = None, max_size = 0, cached = None, on_complete = None):
+        self.helper = helper
+        self.revision = revision
+        self.paths = paths
+        self.max_size = max_size
+        self.cached = cached
+        self.on_complete = on_complete
+        self.size = 0
+        self.truncated = False
+
+    def __iter__(self):
+        if self.cached is not None:
+            for line in self._limit(StringIO(self.cached)):
+                yield line
+            return
+
+        chunks = []
+        complete = False
+        failed = True
+        started = time.time()
+        p = self.helper._open_diff(self.revision, self.paths, self.max_size)
+        try:
+            for line in self._limit(p):
+                if self.on_complete is not None:
+                    chunks.append(line)
+                yield line
+            # the rest of output is not needed if truncated
+            if not self.truncated:
+                _wait(p)
+                complete = True
+            failed = False
+        except GeneratorExit:
+            failed = False
+            raise
+        finally:
+            p.close()
+            self.helper._observe("diff", started, self.size, failed)
+
+        if complete and self.on_complete is not None:
+            self.on_complete("".join(chunks))
+
+    def _limit(self, lines):
+        for line in lines:
+            if self.max_size > 0 and self.size + len(line) > self.max_size:
+                line = line[:self.max_size - self.size]
+                self.size += len(line)
+                self.truncated = True
+                if line:
+                    yield line
+                return
+            self.size += len(line)
+            yield line
+
+def get_infos(urls, timeout = 0, limit = 0):
+    """
+    Runs svn info for all given URLs concurrently (at most limit
+    at the same time) and returns list of dictionaries with svn info
+    output or SubversionException for every URL.
+    """
+    commands = [SubversionHelper(url)._command("info", url) for url in urls]
+    infos = []
+    for (output, error) in run_many(commands, timeout, limit):
+        if error is not None:
+            infos.append(svn_error(error))
+        else:
+            infos.append(parse_info(output))
+    return infos
+
+def parse_info(output):
+    """
+    Parses output of svn info
+
+    >>> info = parse_info('''Path: PROJECT1
+    ... URL: http://svnserver.com/repo/PROJECT1
+    ... Repository Root: http://svnserver.com/repo
+    ... Repository UUID: 2a7a7c4e-2f5b-0410-a1d0-a7e0bfb0eb60
+    ... Revision: 42''')
+    >>> info['Repository Root'], info['Revision']
+    ('http://svnserver.com/repo', '42')
+    """
+    info = {}
+    for line in output.splitlines():
+        (name, sep, value) = line.partition(": ")
+        if sep:
+            info[name] = value.strip()
+    return info
+
+def get_repository_uuid(path, timeout = 0):
+    """Returns UUID of repository in local directory using svnlook"""
+    try:
+        return run(["svnlook", "uuid", path], timeout).strip()
+    except ProcessError, e:
+        raise svn_error(e)
+
+def svn_error(e):
+    """Converts ProcessError to SubversionException"""
+    if isinstance(e, ProcessTimeout):
+        msg = "timed out"
+    else:
+        msg = e.stderr.strip() or "exit code %s" % e.returncode
+    return SubversionException(" ".join(e.command), msg)
+
+def _wait(p):
+    try:
+        p.wait()
+    except ProcessError, e:
+        raise svn_error(e)
+
+def parse_xml_log(stream):
+    """
+    Parses output of svn log --xml -v from the given file-like object
+    and yields Log objects as soon as each log entry is read.
+
+    >>> from StringIO import StringIO
+    >>> logs = list(parse_xml_log(StringIO('''<?xml version="1.0"?>
+    ... <log>
+    ... <logentry revision="12">
+    ... <author>john</author>
+    ... <date>2010-05-05T11:34:56.123456Z</date>
+    ... <paths>
+    ... <path kind="file" action="M">/trunk/PROJECT1/pom.xml</path>
+    ... <path kind="dir" action="A" copyfrom-path="/trunk/a" copyfrom-rev="10">/trunk/b</path>
+    ... </paths>
+    ... <msg>Fixed build
+    ... </msg>
+    ... </logentry>
+    ... </log>''')))
+    >>> logs[0].revision, logs[0].author, logs[0].message
+    (12, 'john', 'Fixed build')
+    >>> logs[0].paths
+    [M /trunk/PROJECT1/pom.xml, A /trunk/b]
+    >>> logs[0].paths[1].copyfrom_rev
+    10
+    """
+    root = None
+    for event, elem in ElementTree.iterparse(stream, events = ("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+        if elem.tag != "logentry":
+            continue
+
+        paths = []
+        for p in elem.findall("paths/path"):
+            copyfrom_rev = p.get("copyfrom-rev")
+            if copyfrom_rev is not None:
+                copyfrom_rev = int(copyfrom_rev)
+            paths.append(ChangedPath(p.get("action"), _text(p.text), p.get("kind"),
+                                     _text(p.get("copyfrom-path")), copyfrom_rev))
+
+        yield Log(_text(elem.findtext("author", "")),
+                  format_xml_date(elem.findtext("date", "")),
+                  _text(elem.findtext("msg", "")).strip(),
+                  int(elem.get("revision")),
+                  paths)
+
+        # free memory used by already parsed entries
+        elem.clear()
+        root.clear()
+
+def _text(value):
+    """
+    ElementTree returns unicode for non-ASCII text, the rest of
+    svn-diff works with UTF-8 encoded strings
+    """
+    if value is not None and not isinstance(value, str):
+        value = value.encode("utf-8")
+    return value
+
+def format_xml_date(date):
+    """
+    Converts date from svn log --xml (UTC) into the local time format
+    used by plain svn log, e.g. '2010-05-05 12:34:56 +0100 (Wed, 05 May 2010)'
+    """
+    if not date:
+        return ""
+    t = calendar.timegm(time.strptime(date[:19], "%Y-%m-%dT%H:%M:%S"))
+    local = time.localtime(t)
+    offset = calendar.timegm(local) - t
+    sign = "+"
+    if offset < 0:
+        sign = "-"
+    offset = abs(offset)
+    return "%s %s%02d%02d (%s)" % (time.strftime("%Y-%m-%d %H:%M:%S", local),
+                                   sign, offset // 3600, offset % 3600 // 60,
+                                   time.strftime("%a, %d %b %Y", local))
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -5,63 +5,216 @@
     [SVN-DIFF]
     interval = default interval in minutes
     subscribers = comma separated list of recipients
-    
+    workers = number of threads checking modules (optional, default 4)
+    max_per_server = maximum number of concurrent checks per SVN server (optional, default 2)
+    start_jitter = maximum random delay of the first check in seconds (optional, default 60)
+    svn_timeout = maximum time in seconds of one svn command (optional, default 600)
+    svn_backend = "cli" runs svn for every operation, "bindings" keeps one session per repository
+                  and check thread open using the Subversion Python bindings and falls back to
+                  "cli" if they are not installed (optional, default cli)
+    smtp_pool_size = maximum number of open SMTP connections (optional, default 2)
+    smtp_max_messages = number of emails sent through one SMTP connection (optional, default 100)
+    delivery_workers = number of threads sending diffs (optional, default 2)
+    delivery_queue_size = maximum number of diffs waiting to be sent per thread (optional, default 100)
+    delivery_retries = number of retries of failed sending (optional, default 8)
+    delivery_backoff = delay in seconds before the first retry, doubled on every retry (optional, default 30)
+    max_diff_size = diffs of whole files are sent until their size reaches max_diff_size bytes,
+                    only diffstat of the rest of files is sent (optional, default 100000)
+    max_diff_read_size = svn diff output is read up to this number of bytes (optional, default 10 MB)
+    diff_cache_dir = directory of diff cache (optional, default ~/.svn-diff/diff-cache)
+    diff_cache_size = maximum size of compressed diffs in cache in bytes, 0 disables cache (optional, default 100 MiB)
+    archive_segment_size = archive segment files are rolled over at this size in bytes (optional, default 64 MiB)
+    notify_socket = UNIX socket receiving commit notifications (optional, default ~/.svn-diff/notify.sock)
+    notify_socket_mode = octal permissions of notify_socket, users allowed to write to it can
+                         notify svndiff (optional, default 0660)
+    notify_interval = interval in minutes of modules with commit notifications (optional, default 60)
+    reload_interval = the config file is checked for changes every reload_interval seconds, added,
+                      removed and changed modules are applied without a restart, 0 disables it
+                      (optional, default 10)
+    metrics_port = port of http://127.0.0.1:port/metrics with metrics in Prometheus format,
+                   0 disables it (optional, default 0), metrics are also written to
+                   ~/.svn-diff/metrics.txt on SIGUSR1
+
     [module1]
     repo = url to SVN repo
     interval = interval to check for diffs in minutes (optional, overrides default)
+    min_interval = interval in minutes after a check found changes (optional, default interval,
+                   can be set in [SVN-DIFF] for all modules)
+    max_interval = while nothing changes the interval is doubled after every check up to
+                   max_interval minutes (optional, default interval, can be set in [SVN-DIFF] for all modules)
     subscribers = comma separated list of recipients (optional, overrides default)
     diff_dir = directory to store diff files instead of sending emails (optional)
+    archive_dir = directory of archive to store diffs in instead of sending emails, diffs are
+                  compressed into segment files indexed by module, revision, date and author,
+                  see "svndiff.py archive --help" (optional)
+    max_diff_paths = if a revision modified at most this number of files in the module
+                     only these files are compared (optional, can be set in [SVN-DIFF] for all modules)
+    diff_exclude = comma separated glob patterns of paths relative to the module which are left
+                   out of diffs, e.g. *.lock, */generated/* (optional, can be set in [SVN-DIFF] for all modules)
+    digest = true to send all revisions found by one check in one email (optional,
+             can be set in [SVN-DIFF] for all modules)
+    digest_max_revisions = maximum number of revisions in one digest (optional, default 50)
+    digest_max_size = maximum size of diffs in one digest in bytes (optional, default 1000000)
+    notify = true if post-commit hook of the repository runs "svndiff.py notify REPOS REV",
+             the module is checked right after every commit and polled every
+             notify_interval minutes only (optional, can be set in [SVN-DIFF] for all modules)
 
 """
 
+from __future__ import with_statement
+
 import sys
 import os
 import os.path
+import copy
+import time
+import socket
+import signal
 import logging
-import smtplib
+from threading import Lock
+from optparse import OptionParser
+from urlparse import urlparse
 from email.mime.text import MIMEText
 from ConfigParser import ConfigParser
 from cgi import escape as escape_html
 
 import template
+import metrics
 import diffparser
 from scheduler import Scheduler
-from svn import SubversionHelper
+from smtppool import SMTPPool
+from delivery import DeliveryQueue, Notification, Digest
+from state import StateStore
+from svn import SubversionHelper, SubversionException, get_infos, get_repository_uuid
+from diffcache import DiffCache
+from archive import Archive, import_diff_dir
+from modules import Module, common_url, group_modules, is_subpath
+from notify import NotifyListener, send as send_notification
+from pool import OrderedPool
+from configwatch import ConfigWatcher, diff_sections
+import bindings
 
 # files and directories
 APP_DIR = os.path.join(os.path.expanduser('~'), '.svn-diff')
 CONFIG_FILE = os.path.join(APP_DIR, 'config')
+STATE_FILE = os.path.join(APP_DIR, 'state.db')
+# used by older versions, imported into STATE_FILE
 LAST_REVS_DIR = os.path.join(APP_DIR, 'last-revs')
+DELIVERED_REVS_DIR = os.path.join(APP_DIR, 'delivered-revs')
+SPOOL_DIR = os.path.join(APP_DIR, 'spool')
+DIFF_CACHE_DIR = os.path.join(APP_DIR, 'diff-cache')
+NOTIFY_SOCKET = os.path.join(APP_DIR, 'notify.sock')
+METRICS_FILE = os.path.join(APP_DIR, 'metrics.txt')
 # TODO: make template location configurable
 TEMPLATE_FILE = os.path.join(os.path.dirname(__file__), "../templates/simple.html")
+DIGEST_TEMPLATE_FILE = os.path.join(os.path.dirname(__file__), "../templates/digest.html")
 
 # configuration names
 MAIN_CONFIG_SECTION = "SVN-DIFF"
 OPT_DEBUG = "debug"
 OPT_INTERVAL = "interval"
+OPT_MIN_INTERVAL = "min_interval"
+OPT_MAX_INTERVAL = "max_interval"
 OPT_SUBSCRIBERS = "subscribers"
 OPT_REPO = "repo"
 OPT_SMTPSERVER = "smtpserver"
 OPT_FROM = "from"
 OPT_FROM_DOMAIN = "from_domain"
 OPT_MAX_DIFFSIZE = "max_diff_size"
+OPT_MAX_DIFF_READ_SIZE = "max_diff_read_size"
+OPT_DIFF_EXCLUDE = "diff_exclude"
 OPT_DIFF_DIR = "diff_dir"
+OPT_ARCHIVE_DIR = "archive_dir"
+OPT_ARCHIVE_SEGMENT_SIZE = "archive_segment_size"
 OPT_GROUP_BY_DATE = "group_by_date"
 OPT_AUTHOR_NAME = "author_name"
+OPT_WORKERS = "workers"
+OPT_MAX_PER_SERVER = "max_per_server"
+OPT_START_JITTER = "start_jitter"
+OPT_SVN_TIMEOUT = "svn_timeout"
+OPT_SVN_BACKEND = "svn_backend"
+OPT_SMTP_POOL_SIZE = "smtp_pool_size"
+OPT_SMTP_MAX_MESSAGES = "smtp_max_messages"
+OPT_DELIVERY_WORKERS = "delivery_workers"
+OPT_DELIVERY_QUEUE_SIZE = "delivery_queue_size"
+OPT_DELIVERY_RETRIES = "delivery_retries"
+OPT_DELIVERY_BACKOFF = "delivery_backoff"
+OPT_MAX_DIFF_PATHS = "max_diff_paths"
+OPT_DIFF_CACHE_DIR = "diff_cache_dir"
+OPT_DIFF_CACHE_SIZE = "diff_cache_size"
+OPT_NOTIFY = "notify"
+OPT_DIGEST = "digest"
+OPT_DIGEST_MAX_REVISIONS = "digest_max_revisions"
+OPT_DIGEST_MAX_SIZE = "digest_max_size"
+OPT_NOTIFY_SOCKET = "notify_socket"
+OPT_NOTIFY_SOCKET_MODE = "notify_socket_mode"
+OPT_NOTIFY_INTERVAL = "notify_interval"
+OPT_METRICS_PORT = "metrics_port"
+OPT_RELOAD_INTERVAL = "reload_interval"
+
+# svn log actions -> diffparser file types
+ACTION_TYPES = {
+    "A": diffparser.TYPE_ADDED,
+    "D": diffparser.TYPE_REMOVED
+}
 
 DEFAULT_CONFIG = {
     OPT_DEBUG: "false",
     OPT_INTERVAL: "0", # run once by default
-    OPT_MAX_DIFFSIZE: "100000" # 100 KiB
+    OPT_MAX_DIFFSIZE: "100000", # 100 KiB
+    OPT_MAX_DIFF_READ_SIZE: "10000000", # 10 MB
+    OPT_WORKERS: "4",
+    OPT_MAX_PER_SERVER: "2",
+    OPT_START_JITTER: "60",
+    OPT_SVN_TIMEOUT: "600",
+    OPT_SVN_BACKEND: "cli",
+    OPT_SMTP_POOL_SIZE: "2",
+    OPT_SMTP_MAX_MESSAGES: "100",
+    OPT_DELIVERY_WORKERS: "2",
+    OPT_DELIVERY_QUEUE_SIZE: "100",
+    OPT_DELIVERY_RETRIES: "8",
+    OPT_DELIVERY_BACKOFF: "30",
+    OPT_DIFF_CACHE_DIR: DIFF_CACHE_DIR,
+    OPT_DIFF_CACHE_SIZE: "104857600", # 100 MiB
+    OPT_ARCHIVE_SEGMENT_SIZE: "67108864", # 64 MiB
+    OPT_NOTIFY_SOCKET: NOTIFY_SOCKET,
+    OPT_NOTIFY_SOCKET_MODE: "0660",
+    OPT_NOTIFY_INTERVAL: "60",
+    OPT_METRICS_PORT: "0",
+    OPT_RELOAD_INTERVAL: "10"
 }
 
-def send_diff(cfg, module, revision, log, diff):
-    if cfg.has_option(module, OPT_DIFF_DIR):
-        send_diff_to_file(cfg, module, revision, log, diff)
+# options of the main section used only when svndiff starts
+RESTART_OPTIONS = (OPT_DEBUG, OPT_WORKERS, OPT_MAX_PER_SERVER, OPT_START_JITTER, OPT_SMTP_POOL_SIZE,
+                   OPT_SMTP_MAX_MESSAGES, OPT_DELIVERY_WORKERS, OPT_DELIVERY_QUEUE_SIZE,
+                   OPT_DELIVERY_RETRIES, OPT_DELIVERY_BACKOFF, OPT_DIFF_CACHE_DIR, OPT_DIFF_CACHE_SIZE,
+                   OPT_ARCHIVE_SEGMENT_SIZE, OPT_NOTIFY_SOCKET, OPT_NOTIFY_SOCKET_MODE, OPT_METRICS_PORT,
+                   OPT_RELOAD_INTERVAL)
+
+POLL_SECONDS = metrics.histogram("svndiff_poll_seconds", "Duration of checks of modules", ("repo",))
+LAG = metrics.gauge("svndiff_module_lag_revisions", "Latest revision minus last checked revision of module",
+                    ("module",))
+CHECK_LAG = metrics.gauge("svndiff_module_check_lag_seconds", "Seconds since the last successful check of module",
+                          ("module",))
+REVISIONS = metrics.counter("svndiff_revisions_total", "Revisions with changes in module", ("module",))
+SKIPPED = metrics.counter("svndiff_skipped_revisions_total", "Revisions without changes in module",
+                          ("module",))
+DIFF_BYTES = metrics.histogram("svndiff_diff_bytes", "Size of diffs of revisions", ("module",),
+                               metrics.SIZE_BUCKETS)
+SEND_SECONDS = metrics.histogram("svndiff_send_seconds", "Duration of sending of diffs",
+                                 ("module", "method"))
+SEND_FAILURES = metrics.counter("svndiff_send_failures_total", "Failed attempts to send diffs",
+                                ("module", "method"))
+
+def send_diff(cfg, module, revision, log, diff, omitted = [], truncated = False):
+    if cfg.has_option(module, OPT_ARCHIVE_DIR):
+        send_diff_to_archive(cfg, module, revision, log, diff, omitted, truncated)
+    elif cfg.has_option(module, OPT_DIFF_DIR):
+        send_diff_to_file(cfg, module, revision, log, diff, omitted, truncated)
     else:
-        send_diff_by_email(cfg, module, revision, log, diff)
+        send_diff_by_email(cfg, module, revision, log, diff, omitted, truncated)
 
-def send_diff_to_file(cfg, module, revision, log, diff):
+def send_diff_to_file(cfg, module, revision, log, diff, omitted = [], truncated = False):
     logger = logging.getLogger(module)
 
     diff_dir = cfg.get(module, OPT_DIFF_DIR)
@@ -73,139 +226,1078 @@ def send_diff_to_file(cfg, module, revision, log, diff):
     diff_file = os.path.join(diff_dir, "%s-%d.diff" % (module, revision))
     logger.info("Writing diff for %d to %s", revision, diff_file)
     f = open(diff_file, 'w')
-    # make commit message look a bit like a diff
-    f.write("Index: commit message\n")
-    f.write("===================================================================\n")
-    f.write("--- commit message\n")
-    f.write("+++ commit message\n")
-    f.write("@@ -0,0 +0,0 @@\n\n")
-    f.write("Author    : %s\n" % log.author_name)
-    f.write("Timestamp : %s\n" % log.timestamp)
-    f.write("Message   : %s\n\n" % log.message)
-    f.write(diff)
-    f.close()
-
-def send_diff_by_email(cfg, module, revision, log, diff):
+    try:
+        f.write(format_diff_file(log, diff, omitted, truncated))
+    finally:
+        f.close()
+
+def send_diff_to_archive(cfg, module, revision, log, diff, omitted = [], truncated = False):
     logger = logging.getLogger(module)
 
-    subscribers = cfg.get(MAIN_CONFIG_SECTION, OPT_SUBSCRIBERS)
-    if cfg.has_option(module, OPT_SUBSCRIBERS):
-        subscribers = cfg.get(module, OPT_SUBSCRIBERS)
+    archive = get_archive(cfg, cfg.get(module, OPT_ARCHIVE_DIR))
+    logger.info("Archiving diff for %d in %s", revision, archive.directory)
+    archive.append(module, revision, log.date(), log.author,
+                   format_diff_file(log, diff, omitted, truncated))
 
+def format_diff_file(log, diff, omitted = [], truncated = False):
+    """Returns content of diff file with commit message as the first diff"""
+    # make commit message look a bit like a diff
+    out = ["Index: commit message\n",
+           "===================================================================\n",
+           "--- commit message\n",
+           "+++ commit message\n",
+           "@@ -0,0 +0,0 @@\n\n",
+           "Author    : %s\n" % log.author_name,
+           "Timestamp : %s\n" % log.timestamp,
+           "Message   : %s\n" % log.message]
+    for omitted_file in omitted:
+        excluded = ""
+        if omitted_file.excluded:
+            excluded = ", excluded"
+        out.append("Omitted   : %s (+%d -%d%s)\n" % (omitted_file.path, omitted_file.lines_added,
+                                                   omitted_file.lines_removed, excluded))
+    if truncated:
+        out.append("Truncated : diff is too big, not all files are listed\n")
+    out.append("\n")
+    out.append(diff)
+    return "".join(out)
+
+def send_diff_by_email(cfg, module, revision, log, diff, omitted = [], truncated = False):
     # create message
+    context = get_revision_context(cfg, module, revision, log, diff, omitted, truncated)
+    
+    # template is compiled once and cached until the file is modified
+    msg_str = template.load(TEMPLATE_FILE).render(context)
+    
+    from_addr = "%s@%s" % (log.author, cfg.get(MAIN_CONFIG_SECTION, OPT_FROM_DOMAIN))
+    subject = "[svn-diff for %s, r%d] %s" % (module, revision, log.message)
+    send_email(cfg, module, from_addr, subject, msg_str)
+
+def send_digest(cfg, digest):
+    if cfg.has_option(digest.module, OPT_ARCHIVE_DIR) or cfg.has_option(digest.module, OPT_DIFF_DIR):
+        # digests make no difference for diff files
+        for n in digest.notifications:
+            send_diff(cfg, n.module, n.revision, n.log, n.diff, n.omitted, n.truncated)
+    else:
+        send_digest_by_email(cfg, digest)
+
+def send_digest_by_email(cfg, digest):
+    module = digest.module
+    revisions = [get_revision_context(cfg, module, n.revision, n.log, n.diff, n.omitted, n.truncated)
+                 for n in digest.notifications]
+    first = digest.notifications[0].revision
     context = {
+        "module": module,
+        "revisions": revisions,
+        "revisions_count": len(revisions),
+        "first_revision": first,
+        "last_revision": digest.revision,
+        "files_count": sum([r["files_count"] for r in revisions]),
+        "lines_added": sum([r["lines_added"] for r in revisions]),
+        "lines_removed": sum([r["lines_removed"] for r in revisions])
+    }
+    msg_str = template.load(DIGEST_TEMPLATE_FILE).render(context)
+
+    # a digest has many authors
+    if cfg.has_option(MAIN_CONFIG_SECTION, OPT_FROM):
+        from_addr = cfg.get(MAIN_CONFIG_SECTION, OPT_FROM)
+    else:
+        from_addr = "svn-diff@%s" % cfg.get(MAIN_CONFIG_SECTION, OPT_FROM_DOMAIN)
+    subject = "[svn-diff for %s, r%d-r%d] %d revisions" % (module, first, digest.revision, len(revisions))
+    send_email(cfg, module, from_addr, subject, msg_str)
+
+def get_revision_context(cfg, module, revision, log, diff, omitted, truncated):
+    """Returns template context of one revision"""
+    files = diffparser.get_files(diff, cfg.get(module, OPT_REPO))
+    return {
         "revision": revision,
         "author": log.author_name,
         "timestamp": log.timestamp,
         "message": escape_html(log.message),
+        "summary": escape_html(log.message.strip().split("\n")[0]),
         "diff": escape_html(diff),
-        "files": diffparser.get_files(diff, cfg.get(module, OPT_REPO))
+        "files": files,
+        "omitted": omitted,
+        "truncated": truncated,
+        "files_count": len(files) + len(omitted),
+        "lines_added": sum([f.lines_added for f in files + omitted]),
+        "lines_removed": sum([f.lines_removed for f in files + omitted])
     }
-    
-    msg_str = template.render(open(TEMPLATE_FILE, 'r').read(), context)
-    
+
+def send_email(cfg, module, from_addr, subject, html):
+    logger = logging.getLogger(module)
+
+    subscribers = cfg.get(MAIN_CONFIG_SECTION, OPT_SUBSCRIBERS)
+    if cfg.has_option(module, OPT_SUBSCRIBERS):
+        subscribers = cfg.get(module, OPT_SUBSCRIBERS)
+
     # create email message
-    from_domain = cfg.get(MAIN_CONFIG_SECTION, OPT_FROM_DOMAIN)
-    from_addr = "%s@%s" % (log.author, from_domain)
-    msg = MIMEText(msg_str, "html")
-    msg['Subject'] = "[svn-diff for %s, r%d] %s" % (module, revision, log.message)
+    msg = MIMEText(html, "html")
+    msg['Subject'] = subject
     msg['From'] = from_addr 
     msg['To'] = subscribers
     
-    # connect to SMTP server and send message
+    # send message using pooled connection to SMTP server
     smtp_server = cfg.get(MAIN_CONFIG_SECTION, OPT_SMTPSERVER)
     logger.info("Sending mail to %s through %s from %s" , subscribers, smtp_server, from_addr)
-    s = smtplib.SMTP(smtp_server)
-    #s.connect()
-    s.sendmail(from_addr, subscribers.split(','), msg.as_string(False))
-    s.close()
+    get_smtp_pool(cfg).sendmail(from_addr, subscribers.split(','), msg.as_string(False))
+
+# SMTP server -> SMTPPool shared by all threads
+_smtp_pools = {}
+_smtp_pools_lock = Lock()
+
+def get_smtp_pool(cfg):
+    smtp_server = cfg.get(MAIN_CONFIG_SECTION, OPT_SMTPSERVER)
+    _smtp_pools_lock.acquire()
+    try:
+        pool = _smtp_pools.get(smtp_server)
+        if pool is None:
+            pool = SMTPPool(smtp_server,
+                            size = cfg.getint(MAIN_CONFIG_SECTION, OPT_SMTP_POOL_SIZE),
+                            max_messages = cfg.getint(MAIN_CONFIG_SECTION, OPT_SMTP_MAX_MESSAGES))
+            _smtp_pools[smtp_server] = pool
+        return pool
+    finally:
+        _smtp_pools_lock.release()
+
+def deliver(cfg, notification):
+    method = "email"
+    if cfg.has_option(notification.module, OPT_ARCHIVE_DIR):
+        method = "archive"
+    elif cfg.has_option(notification.module, OPT_DIFF_DIR):
+        method = "file"
+    labels = {"module": notification.module, "method": method}
+    try:
+        with SEND_SECONDS.time(**labels):
+            if isinstance(notification, Digest):
+                send_digest(cfg, notification)
+            else:
+                # notifications spooled by older versions have no omitted files
+                send_diff(cfg, notification.module, notification.revision, notification.log, notification.diff,
+                          getattr(notification, "omitted", []), getattr(notification, "truncated", False))
+    except Exception:
+        SEND_FAILURES.inc(**labels)
+        raise
+
+def record_delivered(notification):
+    get_state_store().set_delivered(notification.module, notification.revision)
+
+# StateStore shared by all modules
+_state_store = None
+_state_store_lock = Lock()
+
+def get_state_store():
+    global _state_store
+    _state_store_lock.acquire()
+    try:
+        if _state_store is None:
+            if not os.path.exists(APP_DIR):
+                os.makedirs(APP_DIR)
+            _state_store = StateStore(STATE_FILE)
+            _state_store.migrate(LAST_REVS_DIR, DELIVERED_REVS_DIR)
+        return _state_store
+    finally:
+        _state_store_lock.release()
+
+# configuration reloaded by run_command
+_config = None
+
+# DeliveryQueue shared by all modules
+_delivery_queue = None
+_delivery_queue_lock = Lock()
+
+def get_delivery_queue(cfg):
+    global _delivery_queue
+    _delivery_queue_lock.acquire()
+    try:
+        if _delivery_queue is None:
+            # configuration can be reloaded while diffs are sent
+            _delivery_queue = DeliveryQueue(lambda n: deliver(_config or cfg, n), SPOOL_DIR,
+                                            workers = cfg.getint(MAIN_CONFIG_SECTION, OPT_DELIVERY_WORKERS),
+                                            size = cfg.getint(MAIN_CONFIG_SECTION, OPT_DELIVERY_QUEUE_SIZE),
+                                            retries = cfg.getint(MAIN_CONFIG_SECTION, OPT_DELIVERY_RETRIES),
+                                            backoff = cfg.getfloat(MAIN_CONFIG_SECTION, OPT_DELIVERY_BACKOFF),
+                                            delivered = record_delivered)
+            _delivery_queue.start()
+        return _delivery_queue
+    finally:
+        _delivery_queue_lock.release()
     
+# DiffCache shared by all modules
+_diff_cache = None
+_diff_cache_lock = Lock()
+
+def get_diff_cache(cfg):
+    """Returns DiffCache or None if it is disabled"""
+    global _diff_cache
+    if cfg.getint(MAIN_CONFIG_SECTION, OPT_DIFF_CACHE_SIZE) <= 0:
+        return None
+    _diff_cache_lock.acquire()
+    try:
+        if _diff_cache is None:
+            _diff_cache = DiffCache(cfg.get(MAIN_CONFIG_SECTION, OPT_DIFF_CACHE_DIR),
+                                    cfg.getint(MAIN_CONFIG_SECTION, OPT_DIFF_CACHE_SIZE))
+        return _diff_cache
+    finally:
+        _diff_cache_lock.release()
+
+# directory -> Archive shared by all modules
+_archives = {}
+_archives_lock = Lock()
+
+def get_archive(cfg, directory):
+    _archives_lock.acquire()
+    try:
+        archive = _archives.get(directory)
+        if archive is None:
+            archive = Archive(directory, cfg.getint(MAIN_CONFIG_SECTION, OPT_ARCHIVE_SEGMENT_SIZE))
+            _archives[directory] = archive
+        return archive
+    finally:
+        _archives_lock.release()
+
 def check_module(cfg, module, repo):
+    """Check single module using its own URL"""
+    return check_modules(cfg, [Module(module, repo)])
+
+# module -> start of the last successful check
+_checked = {}
+
+# module -> Lock held while the module is checked
+_module_locks = {}
+_module_locks_lock = Lock()
+
+def get_module_locks(modules):
+    """Returns locks of modules ordered by module names"""
+    _module_locks_lock.acquire()
+    try:
+        locks = []
+        for name in sorted(set([m.name for m in modules])):
+            if name not in _module_locks:
+                _module_locks[name] = Lock()
+            locks.append(_module_locks[name])
+        return locks
+    finally:
+        _module_locks_lock.release()
+
+def check_modules(cfg, modules):
+    """
+    Check modules stored in the same repository. Latest revision and
+    logs with changed paths are read once for all modules, diff of a
+    revision is fetched only for modules changed by the revision.
+
+    A module is never checked by two jobs at the same time, e.g. by a
+    job removed by reload_config and the job replacing it, the check
+    waits until the other check is finished and continues after the
+    revisions it found.
+    """
+    locks = get_module_locks(modules)
+    for lock in locks:
+        lock.acquire()
+    try:
+        return _check_modules(cfg, modules)
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+def _check_modules(cfg, modules):
+    url = common_url([m.repo for m in modules])
+    started = time.time()
+
+    # read the latest checked revisions, they are saved once per poll
+    store = get_state_store()
+    states = {}
+    for m in modules:
+        logger = logging.getLogger(m.name)
+        logger.info("Checking %s" % m.name)
+        states[m.name] = store.get(m.name)
+        logger.debug("Last checked revision %d" % states[m.name].last_checked)
+
+    changed = set()
+    latest_rev = None
+    succeeded = False
+    try:
+        # find the latest revision from svn
+        sh = get_helper(cfg, url)
+        latest_rev = sh.get_revision()
+        logging.getLogger(url).debug("Latest remote revision %d" % latest_rev)
+
+        pending = []
+        for m in modules:
+            state = states[m.name]
+            if state.last_checked < 0:
+                state.last_checked = latest_rev
+            elif state.last_checked > 0 and state.last_checked < latest_rev:
+                pending.append(m)
+        
+        # find diffs and send them
+        if pending:
+            first_rev = min([states[m.name].last_checked for m in pending]) + 1
+            logging.getLogger(url).debug("Checking logs for revisions %d:%d" % (first_rev, latest_rev))
+
+            # module -> notifications sent together after the check
+            digests = {}
+            for m in pending:
+                if is_enabled(cfg, m.name, OPT_DIGEST):
+                    digests[m.name] = []
+
+            # svn log returns only revisions with changes under url,
+            # logs are read before sending so that svn log is not kept
+            # running (and timed out) while diffs are sent
+            try:
+                for log in list(sh.get_logs(first_rev, latest_rev)):
+                    # modules with the same URL share diff
+                    diffs = {}
+                    for m in pending:
+                        state = states[m.name]
+                        if log.revision <= state.last_checked:
+                            continue
+                        # changed paths show if diff is needed at all
+                        if not m.touched_by(log):
+                            logging.getLogger(m.name).debug("Skipping revision %d, no changes in module" % log.revision)
+                            state.skipped += 1
+                            SKIPPED.inc(module=m.name)
+                            continue
+                        queue_revision(cfg, m, log, diffs, digests.get(m.name))
+                        changed.add(m.name)
+                        state.last_checked = log.revision
+                        state.revisions += 1
+                        REVISIONS.inc(module=m.name)
+            finally:
+                # revisions found before a failure are sent as well
+                for (name, notifications) in digests.items():
+                    queue_digests(cfg, name, notifications)
+
+            # the rest of revisions have no changes in the modules
+            for m in pending:
+                states[m.name].last_checked = latest_rev
+        succeeded = True
+    finally:
+        duration = time.time() - started
+        POLL_SECONDS.observe(duration, repo=url)
+        for state in states.values():
+            state.polls += 1
+            state.last_poll = started
+            state.poll_duration = duration
+            store.save(state)
+            if latest_rev is not None:
+                LAG.set(max(latest_rev - state.last_checked, 0), module=state.module)
+            # lag grows while checks fail, a module failing since svndiff
+            # started lags behind its first check
+            if succeeded or state.module not in _checked:
+                _checked[state.module] = started
+                CHECK_LAG.set_function(lambda name=state.module: time.time() - _checked[name], module=state.module)
+
+    for m in modules:
+        if m.name not in changed:
+            logging.getLogger(m.name).info("No changes in %s since last check" % m.name)
+    return len(changed) > 0
+
+def queue_revision(cfg, module, log, diffs, digest = None):
+    """
+    Fetch diff of the revision for module and queue it for sending.
+    diffs is a dictionary of diffs of this revision already fetched
+    for other modules (URL -> diff). If digest list is given the
+    notification is appended to it instead of being queued.
+    """
+    notification = get_notification(cfg, module, log, diffs)
+    if digest is not None:
+        digest.append(notification)
+        return
+
+    # diff is spooled and sent in background, polling continues
+    logging.getLogger(module.name).debug("Queuing diff for revision %d" % log.revision)
+    get_delivery_queue(cfg).put(notification)
+
+def get_notification(cfg, module, log, diffs):
+    """Fetch diff of the revision for module, returns Notification"""
     max_diff_size = cfg.getint(MAIN_CONFIG_SECTION, OPT_MAX_DIFFSIZE)
+    max_read_size = cfg.getint(MAIN_CONFIG_SECTION, OPT_MAX_DIFF_READ_SIZE)
+    exclude = get_diff_exclude(cfg, module.name)
+    logger = logging.getLogger(module.name)
+    rev = log.revision
+
+    paths = get_diff_paths(cfg, module, log, exclude)
+    key = (module.repo, paths, tuple(exclude))
+    result = diffs.get(key)
+    if result is None and paths == ():
+        logger.info("All files changed by revision %d are excluded" % rev)
+        result = ("", [], False)
+    elif result is None:
+        logger.info("Getting diff for revision %d" % rev)
+        if paths:
+            logger.debug("Comparing only %s" % ", ".join(paths))
+        sh = get_module_helper(cfg, module)
+        # whole files are kept until max_diff_size is reached, only
+        # diffstat of the rest is counted while svn diff is read
+        stream = sh.get_diff_stream(rev, max_read_size, paths)
+        (diff, omitted) = diffparser.limit_files(stream, max_diff_size, exclude, module.repo)
+        result = (diff, omitted, stream.truncated)
+        diffs[key] = result
+        DIFF_BYTES.observe(stream.size, module=module.name)
+
+        if omitted:
+            logger.info("%d files omitted from diff (max diff size %d)" % (len(omitted), max_diff_size))
+        if stream.truncated:
+            logger.info("Diff size is more than configured max diff read size %d.", max_read_size)
 
+    (diff, omitted, truncated) = result
+    if paths is not None:
+        # excluded files were not compared at all
+        omitted = omitted + get_excluded_files(module, log, exclude)
+
+    # author mapping is configured per module
+    log = copy.copy(log)
+    opt_author_name = OPT_AUTHOR_NAME + "." + log.author
+    if cfg.has_option(module.name, opt_author_name):
+        log.author_name = cfg.get(module.name, opt_author_name)
+
+    return Notification(module.name, rev, log, diff, omitted, truncated)
+
+def queue_digests(cfg, module, notifications):
+    """
+    Queue notifications of module in digests limited by
+    digest_max_revisions and digest_max_size
+    """
+    max_revisions = int(get_module_option(cfg, module, OPT_DIGEST_MAX_REVISIONS, "50"))
+    max_size = int(get_module_option(cfg, module, OPT_DIGEST_MAX_SIZE, "1000000"))
     logger = logging.getLogger(module)
-    
-    logger.info("Checking %s" % module)
-    
-    # read the latest revision from the file
-    last_rev_file = os.path.join(LAST_REVS_DIR, module)
-    last_checked_rev = -1
-    if os.path.exists(last_rev_file):
-        last_checked_rev = int(open(last_rev_file, 'r').read())
-    logger.debug("Last checked revision %d" % last_checked_rev)
-    
-    # find the latest revision from svn
-    sh = SubversionHelper(repo)
-    latest_rev = sh.get_revision()
-    logger.debug("Latest remote revision %d" % latest_rev)
-    
-    # find diffs and send them
-    changed = False
-    if last_checked_rev > 0 and last_checked_rev < latest_rev:
-        for rev in range(last_checked_rev + 1, latest_rev + 1):
-            logger.debug("Checking log for revision %d" % rev)
-            log = sh.get_log(rev)
-
-            # if there are some changes send diff
-            if log is not None:
-                changed = True
-                logger.info("Getting log for revision %d" % rev)
-                diff = sh.get_last_diff(rev)
-
-                if max_diff_size > 0 and len(diff) > max_diff_size:
-                    logger.info("Diff size %d is more than configured max diff size %d.", len(diff), max_diff_size)
-                    diff = diff[:max_diff_size]
-
-                # author mapping
-                opt_author_name = OPT_AUTHOR_NAME + "." + log.author
-                if cfg.has_option(module, opt_author_name):
-                    log.author_name = cfg.get(module, opt_author_name)
-
-                try:
-                    send_diff(cfg, module, rev, log, diff)
-                except Exception:
-                    logger.exception("Failed to send diff for module %s, revision %d: " % (module, rev))
-                    return
-
-            # write last checked revision to the file
-            open(last_rev_file, 'w').write(str(rev))
-   
-    if last_checked_rev < 0:
-        if not os.path.exists(LAST_REVS_DIR):
-            os.makedirs(LAST_REVS_DIR)
-        open(last_rev_file, 'w').write(str(latest_rev))
 
+    digests = []
+    size = 0
+    for n in notifications:
+        if not digests or len(digests[-1]) >= max_revisions or (size + len(n.diff) > max_size and size > 0):
+            digests.append([])
+            size = 0
+        digests[-1].append(n)
+        size += len(n.diff)
+
+    for group in digests:
+        if len(group) == 1:
+            notification = group[0]
+        else:
+            notification = Digest(module, group)
+        logger.debug("Queuing diff for %s" % notification)
+        get_delivery_queue(cfg).put(notification)
+
+def get_module_helper(cfg, module):
+    """Returns SubversionHelper for module URL which uses diff cache"""
+    return get_helper(cfg, module.repo, get_diff_cache(cfg), module.uuid, module.path)
+
+_bindings_warned = False
+
+def get_helper(cfg, url, cache = None, uuid = None, path = None):
+    """Returns SubversionHelper of the configured svn backend"""
+    global _bindings_warned
+    helper_class = SubversionHelper
+    if cfg.get(MAIN_CONFIG_SECTION, OPT_SVN_BACKEND) == "bindings":
+        if bindings.AVAILABLE:
+            helper_class = bindings.BindingsHelper
+        elif not _bindings_warned:
+            logging.warn("Subversion Python bindings are not installed, running svn instead")
+            _bindings_warned = True
+    return helper_class(url, cfg.getint(MAIN_CONFIG_SECTION, OPT_SVN_TIMEOUT), cache, uuid, path)
+
+def get_diff_paths(cfg, module, log, exclude = None):
+    """
+    Returns tuple of paths (relative to the module) which should be
+    compared instead of the whole module or None. Paths are used only if
+    the revision modified at most max_diff_paths files, added, deleted
+    and replaced paths always require the whole module to be compared.
+    Paths matching exclude patterns are never compared, empty tuple is
+    returned if all changed paths are excluded. Paths inside another
+    changed path (e.g. files of a directory whose properties changed)
+    are left out because svn diff would compare them twice.
+
+    >>> from svn import Log, ChangedPath
+    >>> cfg = ConfigParser()
+    >>> cfg.add_section("P1")
+    >>> cfg.set("P1", OPT_MAX_DIFF_PATHS, "5")
+    >>> module = Module("P1", "http://svn/repo/P1", "http://svn/repo")
+    >>> log = Log("bob", "2010-05-05", "", 10, [ChangedPath("M", "/P1/sub", "dir"),
+    ...                                         ChangedPath("M", "/P1/sub/a.txt", "file"),
+    ...                                         ChangedPath("M", "/P1/b.txt", "file")])
+    >>> get_diff_paths(cfg, module, log)
+    ('sub', 'b.txt')
+    """
+    max_paths = int(get_module_option(cfg, module.name, OPT_MAX_DIFF_PATHS, "0"))
+    if max_paths <= 0:
+        return None
+    changed = module.changed_paths(log)
     if not changed:
-        logger.info("No changes in %s since last check" % module)
-        
+        return None
+    changed = [c for c in changed if not diffparser.is_excluded(module.relative_path(c.path), exclude)]
+    if len(changed) > max_paths:
+        return None
+    for c in changed:
+        if c.action != "M" or c.path == module.path:
+            return None
+    paths = [c.path for c in changed]
+    return tuple([module.relative_path(path) for path in paths
+                  if not [parent for parent in paths if parent != path and is_subpath(path, parent)]])
 
-if __name__ == "__main__":
+def get_diff_exclude(cfg, section):
+    """Returns list of glob patterns of files excluded from diffs of module"""
+    value = get_module_option(cfg, section, OPT_DIFF_EXCLUDE, "")
+    return [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+
+def get_excluded_files(module, log, exclude):
+    """Returns list of diffparser.File of files changed by log which are excluded"""
+    files = []
+    for c in module.changed_paths(log) or []:
+        path = module.relative_path(c.path)
+        if c.kind == "dir" or not diffparser.is_excluded(path, exclude):
+            continue
+        type = ACTION_TYPES.get(c.action, diffparser.TYPE_MODIFIED)
+        f = diffparser.File(type, path, "%s/%s" % (module.repo, path))
+        f.excluded = True
+        files.append(f)
+    return files
+
+def get_module_option(cfg, section, option, default = None):
+    """
+    Returns value of option from the module section, from the main
+    section if the module doesn't define it or default
+    """
+    if cfg.has_option(section, option):
+        return cfg.get(section, option)
+    if cfg.has_option(MAIN_CONFIG_SECTION, option):
+        return cfg.get(MAIN_CONFIG_SECTION, option)
+    return default
+
+def resolve_modules(cfg, modules):
+    """
+    Find repository root and UUID of all modules running svn info
+    concurrently. Modules which can not be resolved are checked alone.
+    """
+    infos = get_infos([m.repo for m in modules],
+                      timeout = cfg.getint(MAIN_CONFIG_SECTION, OPT_SVN_TIMEOUT),
+                      limit = cfg.getint(MAIN_CONFIG_SECTION, OPT_WORKERS))
+    resolved = []
+    for (m, info) in zip(modules, infos):
+        root = uuid = None
+        if isinstance(info, SubversionException):
+            logging.warn("Unable to find repository of module %s: %s" % (m.name, info))
+        elif not m.repo.startswith(info.get("Repository Root", "")):
+            logging.warn("URL of module %s is not in repository %s" % (m.name, info.get("Repository Root")))
+        else:
+            root = info.get("Repository Root")
+            uuid = info.get("Repository UUID")
+        resolved.append(Module(m.name, m.repo, root, uuid))
+    return resolved
+
+def is_enabled(cfg, section, option):
+    """Returns True if boolean option of module (or of all modules) is on"""
+    value = get_module_option(cfg, section, option, "false")
+    return value.strip().lower() in ("1", "yes", "true", "on")
+
+def is_notified(cfg, section):
+    """Returns True if post-commit hook notifies about commits to the module"""
+    return is_enabled(cfg, section, OPT_NOTIFY)
+
+def get_interval(cfg, section):
+    """Returns check interval of module in minutes"""
+    if is_notified(cfg, section):
+        # polling is only a safety net for lost notifications
+        return cfg.getint(MAIN_CONFIG_SECTION, OPT_NOTIFY_INTERVAL)
+    if cfg.has_option(section, OPT_INTERVAL):
+        return cfg.getint(section, OPT_INTERVAL)
+    return cfg.getint(MAIN_CONFIG_SECTION, OPT_INTERVAL)
+
+def get_interval_range(cfg, section):
+    """
+    Returns (minimum, maximum) check interval of module in minutes,
+    configured interval is always in the range
+    """
+    interval = get_interval(cfg, section)
+    if is_notified(cfg, section):
+        # changes are found by notifications, polling rarely is enough
+        return (interval, interval)
+    minimum = int(get_module_option(cfg, section, OPT_MIN_INTERVAL, interval))
+    maximum = int(get_module_option(cfg, section, OPT_MAX_INTERVAL, interval))
+    return (min(minimum, interval), max(maximum, interval))
+
+def parse_range(text):
+    """
+    Parses revision range A:B
+
+    >>> parse_range("10:20")
+    (10, 20)
+    """
+    (first, sep, last) = text.partition(":")
+    if not sep:
+        last = first
+    return (int(first), int(last))
+
+def get_module(cfg, name):
+    """Returns Module of the config section with known repository"""
+    if not cfg.has_section(name) or name == MAIN_CONFIG_SECTION:
+        raise ValueError("Unknown module %s" % name)
+    return resolve_modules(cfg, [Module(name, cfg.get(name, OPT_REPO))])[0]
+
+LOG_FORMAT = '%(asctime)s %(name)s %(levelname)s %(message)s'
+
+def load_config():
     if not os.path.isfile(CONFIG_FILE):
         print >> sys.stderr, "No config file found, please create " + CONFIG_FILE
         sys.exit(23)
 
-    cfg = ConfigParser(DEFAULT_CONFIG)
-    cfg.read([CONFIG_FILE])
+    cfg = read_config(CONFIG_FILE)
 
     level = logging.INFO
     if cfg.getboolean(MAIN_CONFIG_SECTION, OPT_DEBUG):
         level=logging.DEBUG
-    logging.basicConfig(level=level, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    logging.basicConfig(level=level, format=LOG_FORMAT)
 
     logging.info("Parsed config file")
+    return cfg
 
+def read_config(path):
+    """Returns ConfigParser of config file, raises ValueError if the file is incomplete"""
+    cfg = ConfigParser(DEFAULT_CONFIG)
+    if not cfg.read([path]):
+        raise ValueError("Unable to read %s" % path)
+    if not cfg.has_section(MAIN_CONFIG_SECTION):
+        raise ValueError("Section [%s] is missing in %s" % (MAIN_CONFIG_SECTION, path))
+    for section in cfg.sections():
+        if section != MAIN_CONFIG_SECTION and not cfg.has_option(section, OPT_REPO):
+            raise ValueError("Module %s has no %s in %s" % (section, OPT_REPO, path))
+    return cfg
+
+def dump_metrics(signum = None, frame = None):
+    """Write metrics to METRICS_FILE, called on SIGUSR1"""
+    f = open(METRICS_FILE, "w")
+    try:
+        f.write(metrics.render())
+    finally:
+        f.close()
+    logging.info("Metrics written to %s" % METRICS_FILE)
+
+def get_jobs(cfg, modules):
+    """
+    Returns dictionary of job name -> (modules, interval, min_interval,
+    max_interval, key), modules from the same repository are checked
+    together by one job
+    """
+    jobs = {}
+    for group in group_modules(modules):
+        interval = min([get_interval(cfg, m.name) for m in group])
+        ranges = [get_interval_range(cfg, m.name) for m in group]
+        min_interval = min([r[0] for r in ranges])
+        max_interval = max(min([r[1] for r in ranges]), interval)
+        repo = common_url([m.repo for m in group])
+        name = group[0].name
+        if len(group) > 1:
+            name = repo
+        # checks of the same SVN server are limited by max_per_server
+        jobs[name] = (tuple(group), interval, min_interval, max_interval, urlparse(repo)[1])
+    return jobs
+
+def schedule_job(s, cfg, name, job, update = False):
+    """Add job returned by get_jobs to scheduler or update it"""
+    (group, interval, min_interval, max_interval, key) = job
+    logging.info(("%s %s (%s), " +
+                  "checking for changes every %d minutes") % (update and "Rescheduling" or "Scheduling",
+                                                              ", ".join([m.name for m in group]),
+                                                              common_url([m.repo for m in group]), interval))
+    if interval > 0 and min_interval < max_interval:
+        logging.info("Interval of %s adapts to changes between %d and %d minutes" % (name, min_interval, max_interval))
+    # check_modules returns True if it found changes
+    if update:
+        s.update(name, interval * 60, args = (cfg, list(group)), key = key,
+                 min_interval = min_interval * 60, max_interval = max_interval * 60)
+    else:
+        s.add(name, interval * 60, check_modules, args = (cfg, list(group)), key = key,
+              min_interval = min_interval * 60, max_interval = max_interval * 60)
+
+def get_notified_jobs(cfg, jobs):
+    """Returns dictionary of repository UUID -> names of jobs checked on commit notifications"""
+    notified_jobs = {}
+    for (name, job) in sorted(jobs.items()):
+        group = job[0]
+        if any([is_notified(cfg, m.name) for m in group]):
+            if group[0].uuid is None:
+                logging.warn("Repository of %s is unknown, commit notifications are ignored" % name)
+            else:
+                notified_jobs.setdefault(group[0].uuid, []).append(name)
+    return notified_jobs
+
+def reload_config(s, daemon, cfg):
+    """
+    Apply reloaded configuration to the running scheduler, jobs of
+    added, removed and changed modules are added, removed and
+    rescheduled. Running checks are left to finish with the previous
+    configuration, checks of their modules by new jobs wait for them
+    (see check_modules).
+    """
+    global _config
+    (added, removed, changed) = diff_sections(daemon["cfg"], cfg)
+    if not (added or removed or changed):
+        logging.info("Configuration is unchanged")
+        return
+    logging.info("Configuration changed, added: %s, removed: %s, changed: %s"
+                 % (", ".join(added) or "-", ", ".join(removed) or "-", ", ".join(changed) or "-"))
+
+    main_changed = MAIN_CONFIG_SECTION in changed
+    if main_changed:
+        old_options = dict(daemon["cfg"].items(MAIN_CONFIG_SECTION, raw = True))
+        new_options = dict(cfg.items(MAIN_CONFIG_SECTION, raw = True))
+        restart = [o for o in RESTART_OPTIONS if old_options.get(o) != new_options.get(o)]
+        if restart:
+            logging.warn("Changes of %s take effect after restart" % ", ".join(restart))
+
+    # svn info is run only for new modules and modules with a new URL
+    known = dict([(m.name, m) for m in daemon["modules"]])
+    modules = []
+    unresolved = []
+    for section in cfg.sections():
+        if section == MAIN_CONFIG_SECTION:
+            continue
+        m = known.get(section)
+        if m is not None and m.repo == cfg.get(section, OPT_REPO):
+            modules.append(m)
+        else:
+            unresolved.append(Module(section, cfg.get(section, OPT_REPO)))
+    if unresolved:
+        logging.info("Finding repositories of %d modules" % len(unresolved))
+        modules.extend(resolve_modules(cfg, unresolved))
+
+    jobs = get_jobs(cfg, modules)
+    old_jobs = daemon["jobs"]
+    for name in sorted(old_jobs.keys()):
+        if name not in jobs:
+            logging.info("Removing %s" % name)
+            s.remove(name)
+    for (name, job) in sorted(jobs.items()):
+        old_job = old_jobs.get(name)
+        if old_job is None:
+            # the first check is delayed by start_jitter as on startup
+            schedule_job(s, cfg, name, job)
+        elif main_changed or old_job[1:] != job[1:] or \
+                [(m.name, m.repo) for m in old_job[0]] != [(m.name, m.repo) for m in job[0]] or \
+                [m for m in job[0] if m.name in changed]:
+            schedule_job(s, cfg, name, job, update = True)
+
+    daemon["cfg"] = cfg
+    daemon["modules"] = modules
+    daemon["jobs"] = jobs
+    daemon["notified_jobs"] = get_notified_jobs(cfg, jobs)
+    if daemon["notified_jobs"] and daemon["listener"] is None:
+        daemon["listener"] = create_notify_listener(cfg, daemon["notified"])
+        daemon["listener"].start()
+    _config = cfg
+    logging.info("%.1f checks per hour" % s.checks_per_hour())
+
+def create_notify_listener(cfg, notified):
+    return NotifyListener(cfg.get(MAIN_CONFIG_SECTION, OPT_NOTIFY_SOCKET), notified,
+                          int(cfg.get(MAIN_CONFIG_SECTION, OPT_NOTIFY_SOCKET_MODE), 8))
+
+def run_command(cfg, args):
+    """Check modules regularly"""
     default_interval = cfg.getint(MAIN_CONFIG_SECTION, OPT_INTERVAL)
     logging.info("Default interval: %d" % default_interval)
-    
-    for section in cfg.sections():
-        if MAIN_CONFIG_SECTION != section:
-            interval = default_interval
-            if cfg.has_option(section, OPT_INTERVAL):
-                interval = cfg.getint(section, OPT_INTERVAL)
-                
-            repo = cfg.get(section, OPT_REPO)
-
-            logging.info(("Starting check thread for module %s (%s)," +
-                          "checking for changes every %d minutes") % (section, repo, interval))
-            s = Scheduler(interval * 60, check_module, args = (cfg, section, repo))
-            s.start()
+
+    s = Scheduler(workers = cfg.getint(MAIN_CONFIG_SECTION, OPT_WORKERS),
+                  max_per_key = cfg.getint(MAIN_CONFIG_SECTION, OPT_MAX_PER_SERVER),
+                  jitter = cfg.getfloat(MAIN_CONFIG_SECTION, OPT_START_JITTER))
+
+    modules = [Module(section, cfg.get(section, OPT_REPO))
+               for section in cfg.sections() if MAIN_CONFIG_SECTION != section]
+    logging.info("Finding repositories of %d modules" % len(modules))
+    modules = resolve_modules(cfg, modules)
+
+    jobs = get_jobs(cfg, modules)
+    for (name, job) in sorted(jobs.items()):
+        schedule_job(s, cfg, name, job)
+
+    # configuration, modules and jobs are replaced when config file changes
+    daemon = {
+        "cfg": cfg,
+        "modules": modules,
+        "jobs": jobs,
+        "notified_jobs": get_notified_jobs(cfg, jobs),
+        "listener": None
+    }
+
+    def notified(uuid, revision):
+        names = daemon["notified_jobs"].get(uuid)
+        if not names:
+            logging.warn("Ignoring revision %d of unknown repository %s" % (revision, uuid))
+            return
+        for name in names:
+            logging.info("Revision %d committed, checking %s" % (revision, name))
+            s.trigger(name)
+    daemon["notified"] = notified
+
+    if daemon["notified_jobs"]:
+        daemon["listener"] = create_notify_listener(cfg, notified)
+        daemon["listener"].start()
+
+    # import state of older versions before checking modules
+    get_state_store()
+
+    # start sending diffs left in the spool by previous run
+    delivery_queue = get_delivery_queue(cfg)
+
+    signal.signal(signal.SIGUSR1, dump_metrics)
+    metrics_port = cfg.getint(MAIN_CONFIG_SECTION, OPT_METRICS_PORT)
+    if metrics_port > 0:
+        metrics.MetricsServer(metrics_port).start()
+
+    logging.info("Starting %d check threads, %.1f checks per hour" % (s.workers, s.checks_per_hour()))
+    s.start()
+
+    watcher = None
+    reload_interval = cfg.getint(MAIN_CONFIG_SECTION, OPT_RELOAD_INTERVAL)
+    if reload_interval > 0:
+        watcher = ConfigWatcher(CONFIG_FILE, read_config)
+    checked = time.time()
+
+    # scheduler stops only if all modules are checked once,
+    # signals and config changes are handled only between waits
+    while not s.join(1.0):
+        if watcher is None or time.time() - checked < reload_interval:
+            continue
+        checked = time.time()
+        reloaded = watcher.check()
+        if reloaded is not None:
+            try:
+                reload_config(s, daemon, reloaded)
+            except Exception:
+                logging.exception("Failed to apply reloaded configuration")
+    if daemon["listener"] is not None:
+        daemon["listener"].close()
+    delivery_queue.join()
+    delivery_queue.cancel()
+
+def cache_command(cfg, args):
+    """Show, prune or prewarm diff cache"""
+    parser = OptionParser(usage = "%prog cache stats\n"
+                                  "       %prog cache prune [--max-size BYTES]\n"
+                                  "       %prog cache prewarm --module MODULE -r FIRST:LAST")
+    parser.add_option("-m", "--module", help = "module (config section) to prewarm")
+    parser.add_option("-r", "--revision", help = "range of revisions to prewarm FIRST:LAST")
+    parser.add_option("--max-size", type = "int", help = "prune cache to this size in bytes")
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("cache command is required")
+
+    cache = get_diff_cache(cfg)
+    if cache is None:
+        parser.error("diff cache is disabled")
+
+    if args[0] == "stats":
+        print "Directory : %s" % cache.directory
+        print "Diffs     : %d" % cache.files
+        print "Size      : %d bytes (maximum %d bytes)" % (cache.size, cache.max_size)
+    elif args[0] == "prune":
+        removed = cache.prune(options.max_size)
+        print "Removed %d diffs, %d bytes left" % (removed, cache.size)
+    elif args[0] == "prewarm":
+        if options.module is None or options.revision is None:
+            parser.error("--module and --revision are required")
+        (first, last) = parse_range(options.revision)
+        module = get_module(cfg, options.module)
+        if module.uuid is None:
+            parser.error("repository of %s is unknown, diffs can not be cached" % module.name)
+        sh = get_module_helper(cfg, module)
+        for log in list(sh.get_logs(first, last)):
+            if module.touched_by(log):
+                sh.get_last_diff(log.revision)
+        print "Prewarmed %s r%d:%d, %d diffs were already cached, %d fetched" % (module.name, first, last, cache.hits, cache.misses)
+    else:
+        parser.error("unknown cache command %s" % args[0])
+
+def notify_command(cfg, args):
+    """
+    Notify running svndiff about a new revision, used in post-commit hooks.
+    cfg is None if the user running the hook has no config file.
+    """
+    parser = OptionParser(usage = "%prog notify [--socket PATH] REPOS_PATH REVISION")
+    parser.add_option("-s", "--socket",
+                      help = "notify_socket of the running svndiff (default notify_socket of the config), "
+                             "required if the hook runs as a user without config file")
+    (options, args) = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error("repository path and revision are required")
+    try:
+        revision = int(args[1])
+    except ValueError:
+        parser.error("invalid revision %s" % args[1])
+    if cfg is None and options.socket is None:
+        parser.error("--socket is required, no config file found at %s" % CONFIG_FILE)
+
+    timeout = int(DEFAULT_CONFIG[OPT_SVN_TIMEOUT])
+    if cfg is not None:
+        timeout = cfg.getint(MAIN_CONFIG_SECTION, OPT_SVN_TIMEOUT)
+    uuid = get_repository_uuid(args[0], timeout)
+    path = options.socket
+    if path is None:
+        path = cfg.get(MAIN_CONFIG_SECTION, OPT_NOTIFY_SOCKET)
+    try:
+        send_notification(path, uuid, revision)
+    except socket.error, e:
+        # the revision is found by the next regular check
+        logging.warn("Unable to notify svndiff through %s: %s" % (path, e))
+
+def archive_command(cfg, args):
+    """Read diffs from archive or import diff files into it"""
+    parser = OptionParser(usage = "%prog archive get --module MODULE -r FIRST:LAST [--output FILE]\n"
+                                  "       %prog archive list [--module MODULE] [-r FIRST:LAST] [--author AUTHOR]\n"
+                                  "                          [--since YYYY-MM-DD] [--until YYYY-MM-DD]\n"
+                                  "       %prog archive import --module MODULE [--diff-dir DIR]")
+    parser.add_option("-m", "--module", help = "module (config section) with archive_dir")
+    parser.add_option("-r", "--revision", help = "revision or range of revisions FIRST:LAST")
+    parser.add_option("--author", help = "only diffs committed by AUTHOR")
+    parser.add_option("--since", help = "only diffs committed on or after the date")
+    parser.add_option("--until", help = "only diffs committed on or before the date")
+    parser.add_option("--diff-dir", help = "directory of diff files to import (default diff_dir of the module)")
+    parser.add_option("-o", "--output", help = "write diffs to FILE instead of stdout")
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("archive command is required")
+
+    # modules with archive_dir, all of them if no module is given
+    sections = [section for section in cfg.sections()
+                if section != MAIN_CONFIG_SECTION and cfg.has_option(section, OPT_ARCHIVE_DIR)]
+    if options.module is not None:
+        if options.module not in sections:
+            parser.error("module %s has no %s" % (options.module, OPT_ARCHIVE_DIR))
+        sections = [options.module]
+    if not sections:
+        parser.error("no module has %s" % OPT_ARCHIVE_DIR)
+    (first, last) = (None, None)
+    if options.revision is not None:
+        (first, last) = parse_range(options.revision)
+
+    if args[0] == "get":
+        if options.module is None or options.revision is None:
+            parser.error("--module and --revision are required")
+        archive = get_archive(cfg, cfg.get(options.module, OPT_ARCHIVE_DIR))
+        out = sys.stdout
+        if options.output:
+            out = open(options.output, "w")
+        try:
+            for entry in archive.find(options.module, first, last):
+                out.write(archive.read(entry))
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    elif args[0] == "list":
+        # modules can share an archive
+        directories = []
+        for section in sections:
+            directory = cfg.get(section, OPT_ARCHIVE_DIR)
+            if directory not in directories:
+                directories.append(directory)
+        for directory in directories:
+            for entry in get_archive(cfg, directory).find(options.module, first, last,
+                                                          options.author, options.since, options.until):
+                if entry.module in sections:
+                    print "%s\t%d\t%s\t%s" % (entry.module, entry.revision, entry.date, entry.author)
+    elif args[0] == "import":
+        if options.module is None:
+            parser.error("--module is required")
+        diff_dir = options.diff_dir
+        if diff_dir is None:
+            if not cfg.has_option(options.module, OPT_DIFF_DIR):
+                parser.error("--diff-dir is required, module %s has no %s" % (options.module, OPT_DIFF_DIR))
+            diff_dir = cfg.get(options.module, OPT_DIFF_DIR)
+        archive = get_archive(cfg, cfg.get(options.module, OPT_ARCHIVE_DIR))
+        imported = import_diff_dir(archive, diff_dir, options.module, get_author_logins(cfg, options.module))
+        print "Imported %d diffs of %s from %s" % (imported, options.module, diff_dir)
+    else:
+        parser.error("unknown archive command %s" % args[0])
+
+def get_author_logins(cfg, section):
+    """Returns dictionary of author names of module -> logins"""
+    prefix = OPT_AUTHOR_NAME + "."
+    logins = {}
+    for (option, value) in cfg.items(section, raw = True):
+        if option.startswith(prefix):
+            logins[value] = option[len(prefix):]
+    return logins
+
+def backfill_command(cfg, args):
+    """Send diffs of past revisions of a module"""
+    parser = OptionParser(usage = "%prog backfill --module MODULE -r FIRST:LAST [--workers N] [--restart]")
+    parser.add_option("-m", "--module", help = "module (config section) to backfill")
+    parser.add_option("-r", "--revision", help = "range of revisions FIRST:LAST")
+    parser.add_option("-w", "--workers", type = "int",
+                      help = "number of diffs fetched at the same time (default workers of the config)")
+    parser.add_option("--restart", action = "store_true", default = False,
+                      help = "ignore checkpoint of previous backfill of the same range")
+    (options, args) = parser.parse_args(args)
+    if args:
+        parser.error("unexpected arguments %s" % " ".join(args))
+    if options.module is None or options.revision is None:
+        parser.error("--module and --revision are required")
+    (first, last) = parse_range(options.revision)
+    workers = options.workers or cfg.getint(MAIN_CONFIG_SECTION, OPT_WORKERS)
+
+    module = get_module(cfg, options.module)
+    logger = logging.getLogger(module.name)
+    store = get_state_store()
+
+    # revisions up to the checkpoint were sent by an interrupted backfill
+    checkpoint_name = "backfill.%s" % module.name
+    range_prefix = "%d:%d:" % (first, last)
+    checkpoint = store.get_checkpoint(checkpoint_name)
+    start = first
+    if checkpoint is not None and checkpoint.startswith(range_prefix) and not options.restart:
+        start = int(checkpoint[len(range_prefix):]) + 1
+        if start > last:
+            print "%s r%d:%d is already backfilled, use --restart to send it again" % (module.name, first, last)
+            return
+        logger.info("Resuming backfill of r%d:%d from r%d" % (first, last, start))
+
+    sh = get_module_helper(cfg, module)
+    logs = [log for log in sh.get_logs(start, last) if log.revision >= start and module.touched_by(log)]
+    logger.info("Backfilling %d revisions of r%d:%d using %d workers" % (len(logs), start, last, workers))
+
+    # diffs are fetched concurrently, but sent in revision order by this
+    # process, the spool is left to the daemon which would send spooled
+    # diffs of a DeliveryQueue started here as well. A failure stops
+    # the backfill, it resumes after the last sent revision.
+    pool = OrderedPool(lambda log: get_notification(cfg, module, log, {}), workers)
+    sent = 0
+    for notification in pool.map(logs):
+        deliver(cfg, notification)
+        record_delivered(notification)
+        store.set_checkpoint(checkpoint_name, range_prefix + str(notification.revision))
+        sent += 1
+    store.set_checkpoint(checkpoint_name, range_prefix + str(last))
+
+    # regular checks continue after the backfilled range unless they
+    # are behind it
+    if not store.advance_checked(module.name, first, last):
+        state = store.get(module.name)
+        if state.last_checked < first - 1:
+            logger.warn("Last checked revision r%d is before r%d, revisions r%d:%d are sent again by regular checks"
+                        % (state.last_checked, first, first, last))
+
+    print "Backfilled %s r%d:%d, %d revisions sent" % (module.name, start, last, sent)
+
+COMMANDS = {
+    "run": run_command,
+    "cache": cache_command,
+    "notify": notify_command,
+    "backfill": backfill_command,
+    "archive": archive_command
+}
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    command = "run"
+    if args and not args[0].startswith("-"):
+        command = args.pop(0)
+    if command not in COMMANDS:
+        print >> sys.stderr, "Unknown command %s, available commands: %s" % (command, ", ".join(sorted(COMMANDS.keys())))
+        sys.exit(2)
+
+    if command == "notify" and not os.path.isfile(CONFIG_FILE):
+        # hooks may run as another user than svndiff, see notify_command
+        logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+        COMMANDS[command](None, args)
+    else:
+        COMMANDS[command](load_config(), args)
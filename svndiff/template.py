@@ -3,7 +3,7 @@
   Supports following features:
 
   - variable substitution using ${var_name[.prop_name]} syntax
-    prop_name can be object method without arguments
+    prop_name can be object method without arguments or key of dictionary
   - if statement using following syntax (if and endif should be on separate lines)::
     
       #if(expr)
@@ -15,9 +15,20 @@
       #for(var in list_var_name)
           content goes here ${var}, ${var_index}
       #endif
+
+  Templates are compiled once into a tree of nodes which can be
+  rendered many times, compiled template files are cached.
 """
 
+from __future__ import with_statement
+
 import re
+import os
+from threading import Lock
+
+import metrics
+
+RENDER_SECONDS = metrics.histogram("svndiff_render_seconds", "Duration of rendering of templates")
 
 EXPR_SUBST_RE = re.compile(r"(\$\{[.\w]+\})")
 
@@ -42,13 +53,18 @@ def eval_expr(expr, context):
     VALUE
     >>> print eval_expr("var.upper.lower", {'var': 'vAluE'})
     value
+    >>> print eval_expr("var.key", {'var': {'key': 'value'}})
+    value
     """
     parts = expr.split(".")
     
     value = context.get(parts[0], None)
     i = 1;
     while value is not None and i < len(parts):
-        value = getattr(value, parts[i])
+        if isinstance(value, dict):
+            value = value.get(parts[i], None)
+        else:
+            value = getattr(value, parts[i])
         if callable(value):
             value = value()
         i += 1
@@ -123,76 +139,156 @@ def render(template, context):
     - Pear
     -- Green Pear
     -- Red Pear
+
+    >>> print render('''#for (rev in revisions)
+    ... r${rev.revision}
+    ... #for (file in rev.files)
+    ... ${rev_index}.${file_index} ${file}
+    ... #endfor
+    ... #endfor''',
+    ... {'revisions': [{'revision': 10, 'files': ['a', 'b']}, {'revision': 12, 'files': ['c']}]})
+    r10
+    0.0 a
+    0.1 b
+    r12
+    1.0 c
     """
-    
-    result = ""
-    
-    if_stack = [] # elements are evaluated expressions from context
+    return compile(template).render(context)
+
+class Template:
+    """
+    Compiled template
+
+    >>> t = compile('''#for (var in list)
+    ... ${var_index}: ${var}
+    ... #endfor''')
+    >>> print t.render({'list': ('a', 'b')})
+    0: a
+    1: b
+    >>> print t.render({'list': ('c',)})
+    0: c
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def render(self, context):
+        """
+        Render template using variables from context dictionary
+        """
+        out = []
+        with RENDER_SECONDS.time():
+            _render_nodes(self.nodes, context, out)
+            return "".join(out).strip()
+
+class TextNode:
+    def __init__(self, line):
+        # odd elements are expressions, even elements are text
+        self.parts = EXPR_SUBST_RE.split(line)
+        for i in range(1, len(self.parts), 2):
+            self.parts[i] = self.parts[i][2:-1]
+
+    def render(self, context, out):
+        parts = self.parts
+        out.append(parts[0])
+        for i in range(1, len(parts), 2):
+            out.append(str(eval_expr(parts[i], context)))
+            out.append(parts[i + 1])
+        out.append("\n")
+
+class IfNode:
+    def __init__(self, expr):
+        self.expr = expr
+        self.children = []
+
+    def render(self, context, out):
+        if eval_expr(self.expr, context):
+            _render_nodes(self.children, context, out)
+
+class ForNode:
+    def __init__(self, var_name, expr):
+        self.var_name = var_name
+        self.index_name = "%s_index" % var_name
+        self.expr = expr
+        self.children = []
+
+    def render(self, context, out):
+        collection = eval_expr(self.expr, context)
+
+        # render content for every element in collection
+        for_context = {}
+        for_context.update(context)
+        for (index, elem) in enumerate(collection):
+            for_context[self.var_name] = elem
+            for_context[self.index_name] = index
+            sub_out = []
+            _render_nodes(self.children, for_context, sub_out)
+            out.append("".join(sub_out).strip())
+            out.append("\n")
+
+def _render_nodes(nodes, context, out):
+    for node in nodes:
+        node.render(context, out)
+
+def compile(template):
+    """
+    Parse given template into Template object
+    """
+    root = []
+    stack = [] # open if/for nodes
+    children = root
 
-    for_match = None
-    for_sub_template = ""
-    for_count = 0
-    
     for line in template.splitlines():
-        # found endfor - render for_sub_template
-        if line.find(END_FOR) >= 0:
-            if for_count == 1:
-                # parse for expression
-                var_name = for_match.group(1)
-                collection = eval_expr(for_match.group(2), context)
-                
-                # render for template every element in collection
-                for_context = {}
-                for_context.update(context)
-                for (index, elem) in enumerate(collection):
-                    for_context[var_name] = elem
-                    for_context["%s_index" % var_name] = index
-                    result += render(for_sub_template, for_context)
-                    result += "\n"
-                    
-                # reset current state
-                for_match = None
-                for_sub_template = ""
-                for_count = 0
+        if line.find(END_FOR) >= 0 or line.find(END_IF) >= 0:
+            if stack:
+                stack.pop()
+            if stack:
+                children = stack[-1].children
             else:
-                for_sub_template += "%s\n" % line
-                for_count -= 1
-
+                children = root
             continue
-        
+
+        node = None
         m = FOR_RE.search(line)
         if m is not None:
-            for_count += 1
+            node = ForNode(m.group(1), m.group(2))
+        else:
+            m = IF_RE.search(line)
+            if m is not None:
+                node = IfNode(m.group(1))
 
-        # collect "for sub template"
-        if for_match is not None:
-            for_sub_template += "%s\n" % line
-            continue
-        
-        # handle for
-        if for_match is None and m is not None:
-            for_match = m
-            continue
-        
-        # handle if
-        if len(if_stack) > 0 and not if_stack[-1]:
-            continue
-        m = IF_RE.search(line)
-        if m is not None:
-            if_stack.append(eval_expr(m.group(1), context))
-            continue
-        if line.find(END_IF) >= 0:
-            if_stack.pop()
-            continue
-        
-        # handle expressions
-        for expr in EXPR_SUBST_RE.findall(line):
-            line = line.replace(expr, str(eval_expr(expr[2:-1], context)))
+        if node is None:
+            children.append(TextNode(line))
+        else:
+            children.append(node)
+            stack.append(node)
+            children = node.children
 
-        result += line
-        result += "\n"
-        
-    return result.strip()
+    return Template(root)
+
+# path -> (modification time, Template)
+_cache = {}
+_cache_lock = Lock()
+
+def load(path):
+    """
+    Returns compiled template from the given file. Templates are
+    cached and compiled again only if the file is modified.
+    """
+    mtime = os.stat(path).st_mtime
+    with _cache_lock:
+        cached = _cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    f = open(path, 'r')
+    try:
+        t = compile(f.read())
+    finally:
+        f.close()
+
+    with _cache_lock:
+        _cache[path] = (mtime, t)
+    return t
 
 if __name__ == "__main__":
     import doctest